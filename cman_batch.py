@@ -0,0 +1,231 @@
+import argparse
+import random
+import time
+import numpy as np
+from cman_game import Game, Player, Direction, State, MAX_ATTEMPTS
+
+NO_MOVE = -1  # Direction value meaning the player does not move this step
+
+class BatchGame:
+    """
+
+    Simulates many games on the same map in lockstep, with the state of game i stored at index i
+    of NumPy arrays. Moves follow the same rules as cman_game.Game.apply_move, including point
+    collection, captures, round resets and wins.
+
+    """
+    def __init__(self, map_path, n_games):
+        """
+
+        Creates n_games games on the same map, all in State.WAIT like a new Game.
+
+        Parameters:
+
+        map_path (str): a path to the textual map file
+
+        n_games (int): the number of games to simulate
+
+        """
+        game = Game(map_path)
+        self.n_games = n_games
+        self.n_points = len(game.point_index)
+        self.win_score = game.win_score
+        self.neighbors = np.array(game.neighbors, dtype=np.int32).reshape(-1, len(Direction))
+        self.cell_point = np.array(game.cell_point, dtype=np.int32)
+        self.cell_coords = np.array(game.cell_coords, dtype=np.int32)
+        self.start_cells = np.array(game.start_cells, dtype=np.int32)
+        self.index = np.arange(n_games)
+
+        self.cells = np.empty((len(Player) - 1, n_games), dtype=np.int32)  # cells[player][game]
+        self.lives = np.empty(n_games, dtype=np.int16)
+        self.score = np.empty(n_games, dtype=np.int16)
+        self.collected = np.empty((n_games, self.n_points), dtype=bool)
+        self.state = np.empty(n_games, dtype=np.int8)
+        self.winner = np.empty(n_games, dtype=np.int8)
+        self.restart_games(np.ones(n_games, dtype=bool))
+
+    def restart_games(self, mask):
+        """
+
+        Restarts the selected games to their initial values, like Game.restart_game.
+
+        Parameters:
+
+        mask (np.ndarray): boolean array selecting the games to restart
+
+        """
+        self.cells[:, mask] = self.start_cells[:, None]
+        self.lives[mask] = MAX_ATTEMPTS
+        self.score[mask] = 0
+        self.collected[mask] = False
+        self.state[mask] = State.WAIT
+        self.winner[mask] = Player.NONE
+
+    def _declare_winner(self, mask, player):
+        mask = mask & (self.state != State.WIN)
+        self.state[mask] = State.WIN
+        self.winner[mask] = player
+
+    def _apply_moves(self, player, directions):
+        state = self.state
+        if player == Player.CMAN:
+            active = (state == State.PLAY) | (state == State.START)
+        else:
+            active = state == State.PLAY
+        active &= directions != NO_MOVE
+
+        cells = self.cells[player]
+        next_cells = self.neighbors[cells, np.where(active, directions, 0)]
+        moved = active & (next_cells >= 0)
+        games = self.index[moved]
+        if not len(games):
+            return moved
+        next_cells = next_cells[games]
+        state[games] = State.PLAY
+        cells[games] = next_cells
+
+        if player == Player.CMAN:
+            bits = self.cell_point[next_cells]
+            on_point = bits >= 0
+            point_games, bits = games[on_point], bits[on_point]
+            fresh = ~self.collected[point_games, bits]
+            point_games, bits = point_games[fresh], bits[fresh]
+            self.collected[point_games, bits] = True
+            self.score[point_games] += 1
+            won = np.zeros(self.n_games, dtype=bool)
+            won[point_games[self.score[point_games] >= self.win_score]] = True
+            self._declare_winner(won, Player.CMAN)
+
+        caught = games[self.cells[Player.CMAN][games] == self.cells[Player.SPIRIT][games]]
+        if len(caught):
+            self.lives[caught] -= 1
+            dead = np.zeros(self.n_games, dtype=bool)
+            dead[caught[self.lives[caught] <= 0]] = True
+            self._declare_winner(dead, Player.SPIRIT)
+            new_round = caught[self.lives[caught] > 0]
+            self.cells[:, new_round] = self.start_cells[:, None]
+            state[new_round] = State.START
+        return moved
+
+    def step(self, cman_moves, spirit_moves):
+        """
+
+        Applies one move per player in every game, Cman's first, like two Game.apply_move calls.
+
+        Parameters:
+
+        cman_moves (np.ndarray): Direction of Cman's move in each game, or NO_MOVE
+
+        spirit_moves (np.ndarray): Direction of the Spirit's move in each game, or NO_MOVE
+
+        Returns:
+
+        tuple(np.ndarray, np.ndarray): For each player, whether its move changed the game state
+
+        """
+        return self._apply_moves(Player.CMAN, cman_moves), self._apply_moves(Player.SPIRIT, spirit_moves)
+
+    def get_players_coords(self, player):
+        """
+
+        Returns:
+
+        np.ndarray: (n_games, 2) array with the coordinates of player in each game
+
+        """
+        return self.cell_coords[self.cells[player]]
+
+    def get_collected_masks(self):
+        """
+
+        Returns:
+
+        list[int]: The collected points mask of each game, as returned by Game.get_collected_mask
+
+        """
+        packed = np.packbits(self.collected, axis=1, bitorder='little')
+        return [int.from_bytes(row.tobytes(), 'little') for row in packed]
+
+def check_parity(map_path, n_games, steps, seed=0, move_chance=0.8):
+    """
+
+    Plays random moves on a BatchGame and on one scalar Game per batch slot and compares
+    their full state after every step.
+
+    Returns:
+
+    int: The number of moves compared
+
+    """
+    rng = np.random.default_rng(seed)
+    batch = BatchGame(map_path, n_games)
+    games = [Game(map_path) for _ in range(n_games)]
+    batch.state[:] = State.START
+    for game in games:
+        game.state = State.START
+
+    compared = 0
+    for step in range(steps):
+        moves = rng.integers(0, len(Direction), size=(2, n_games))
+        moves[rng.random((2, n_games)) > move_chance] = NO_MOVE
+        changed = batch.step(moves[0], moves[1])
+        for i, game in enumerate(games):
+            for player in (Player.CMAN, Player.SPIRIT):
+                if moves[player][i] != NO_MOVE:
+                    result = game.apply_move(player, Direction(int(moves[player][i])))
+                    assert result == changed[player][i], f"step {step}, game {i}: apply_move result differs"
+                    compared += 1
+
+        masks = batch.get_collected_masks()
+        for i, game in enumerate(games):
+            expected = (tuple(game.cur_coords[Player.CMAN]), tuple(game.cur_coords[Player.SPIRIT]), game.lives,
+                        game.score, game.get_collected_mask(), int(game.state), int(game.get_winner()))
+            actual = (tuple(batch.get_players_coords(Player.CMAN)[i]), tuple(batch.get_players_coords(Player.SPIRIT)[i]),
+                      int(batch.lives[i]), int(batch.score[i]), masks[i], int(batch.state[i]),
+                      int(batch.winner[i]) if batch.state[i] == State.WIN else int(Player.NONE))
+            assert expected == actual, f"step {step}, game {i}: expected {expected}, got {actual}"
+
+        finished = batch.state == State.WIN
+        if finished.any():
+            batch.restart_games(finished)
+            batch.state[finished] = State.START
+            for i in np.flatnonzero(finished):
+                games[i].restart_game()
+                games[i].state = State.START
+    return compared
+
+def benchmark(map_path, n_games, steps, seed=0):
+    """
+
+    Returns:
+
+    float: Moves per second applied by a BatchGame of n_games games playing random moves
+
+    """
+    rng = np.random.default_rng(seed)
+    batch = BatchGame(map_path, n_games)
+    batch.state[:] = State.START
+    moves = rng.integers(0, len(Direction), size=(steps, 2, n_games))
+    start = time.perf_counter()
+    for step in range(steps):
+        batch.step(moves[step][0], moves[step][1])
+        finished = batch.state == State.WIN
+        if finished.any():
+            batch.restart_games(finished)
+            batch.state[finished] = State.START
+    return 2 * n_games * steps / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch C-Man simulation: parity check against Game and throughput")
+    parser.add_argument('--map', default="map.txt")
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=random.randrange(2**32))
+    parser.add_argument('--parity', action='store_true', help="compare every step against scalar Game instances")
+    args = parser.parse_args()
+
+    if args.parity:
+        compared = check_parity(args.map, args.games, args.steps, args.seed)
+        print(f"Parity OK: {compared} moves over {args.games} games (seed {args.seed})")
+    rate = benchmark(args.map, args.games, args.steps, args.seed)
+    print(f"{rate:,.0f} moves/s with {args.games} games in lockstep")
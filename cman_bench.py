@@ -0,0 +1,226 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+import cman_game_map as gm
+import cman_protocol as proto
+import cman_server as server
+from cman_game import Game, Player, Direction, State, MAX_ATTEMPTS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAP_PATH = os.path.join(HERE, "map.txt")
+WATCHERS = 500  # Watchers in the room used by the broadcast benchmarks
+THRESHOLD = 0.15  # Relative slowdown over the baseline reported as a regression
+
+benchmarks = {}  # name -> function returning (setup-free callable, operations per call)
+
+def benchmark(name):
+    """Registers a benchmark factory under name."""
+    def register(factory):
+        benchmarks[name] = factory
+        return factory
+    return register
+
+class NullSocket:
+    """Stands in for the server socket so broadcasts measure encoding and fan-out, not the kernel."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, message, addr):
+        self.sent += len(message)
+
+def random_moves(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.choice((Player.CMAN, Player.SPIRIT)), Direction(rng.randrange(4))) for _ in range(n)]
+
+def make_room(watchers):
+    """Create a playing room with both players and the given number of watchers."""
+    server.MAP_PATH = MAP_PATH
+    server.server_socket = NullSocket()
+    room = server.Room(0)
+    server.seat_client(room, ('10.0.0.1', 1), Player.CMAN, 0)
+    server.seat_client(room, ('10.0.0.2', 1), Player.SPIRIT, 0)
+    for i in range(watchers):
+        server.seat_client(room, ('10.1.%d.%d' % (i // 256, i % 256), 2), Player.NONE, 0)
+    room.game.state = State.PLAY
+    return room
+
+@benchmark("game.apply_move")
+def bench_apply_move():
+    game = Game(MAP_PATH)
+    moves = random_moves(1000)
+    def run():
+        game.state = State.PLAY
+        for player, direction in moves:
+            if game.state == State.WIN:
+                game.state = State.PLAY
+            game.apply_move(player, direction)
+    return run, len(moves)
+
+@benchmark("game.apply_moves")
+def bench_apply_moves():
+    game = Game(MAP_PATH)
+    moves = bytes(player << 2 | direction for player, direction in random_moves(1000))
+    def run():
+        if game.state == State.WIN:
+            game.restart_game()
+        game.state = State.PLAY
+        game.apply_moves(moves)
+    return run, len(moves)
+
+@benchmark("game.restart_game")
+def bench_restart_game():
+    game = Game(MAP_PATH)
+    return game.restart_game, 1
+
+@benchmark("game.new")
+def bench_new_game():
+    Game(MAP_PATH)  # Compiles and memoizes the map, later games reuse it
+    return (lambda: Game(MAP_PATH)), 1
+
+@benchmark("game_map.read_map")
+def bench_read_map():
+    return (lambda: gm.read_map(MAP_PATH)), 1
+
+@benchmark("server.get_game_update")
+def bench_get_game_update():
+    room = make_room(WATCHERS)
+    addr = ('10.0.0.1', 1)
+    return (lambda: server.get_game_update(room, addr)), 1
+
+@benchmark(f"server.send_update_to_all[{WATCHERS} watchers]")
+def bench_send_update_to_all():
+    room = make_room(WATCHERS)
+    return (lambda: server.send_update_to_all(room)), 1
+
+@benchmark(f"server.send_update_to_all[{WATCHERS} sequenced watchers]")
+def bench_send_update_to_all_sequenced():
+    room = make_room(WATCHERS)
+    for session in room.clients.values():
+        session.sequenced = True
+    server.send_update_to_all(room)  # First broadcast is a keyframe, later ones deltas
+    return (lambda: server.send_update_to_all(room)), 1
+
+def sample_updates(n=1000):
+    """Encoded 0x80 messages of a random game, one per state change."""
+    game = Game(MAP_PATH)
+    game.state = State.START
+    room_state = lambda: (game.cur_coords[0], game.cur_coords[1], MAX_ATTEMPTS - game.lives, game.get_collected_mask())
+    updates = []
+    for player, direction in random_moves(20 * n, seed=1):
+        if game.state == State.WIN:
+            game.restart_game()
+            game.state = State.START
+        if game.apply_move(player, direction):
+            updates.append(server.encode_game_update(room_state())[0])
+            if len(updates) == n:
+                break
+    return updates
+
+@benchmark("client.decode 0x80")
+def bench_decode_update():
+    updates = sample_updates()
+    def run():
+        for data in updates:
+            proto.decode_update(data)
+    return run, len(updates)
+
+@benchmark("client.apply keyframe/delta")
+def bench_sequenced_apply():
+    game = Game(MAP_PATH)
+    game.state = State.START
+    messages = []
+    previous = None
+    for player, direction in random_moves(20000, seed=2):
+        if game.state == State.WIN:
+            break
+        if game.apply_move(player, direction):
+            state = (game.cur_coords[0], game.cur_coords[1], MAX_ATTEMPTS - game.lives, game.get_collected_mask())
+            seq = len(messages) + 1
+            if previous is None or seq % 32 == 0:
+                messages.append(proto.encode_keyframe(seq, 0, state))
+            else:
+                messages.append(proto.encode_delta(seq, 0, previous, state))
+            previous = state
+    def run():
+        state = proto.SequencedState()
+        for data in messages:
+            state.apply(data)
+    return run, len(messages)
+
+@benchmark("client.update_and_print_map")
+def bench_update_and_print_map():
+    import cman_client as client  # Needs pynput through cman_utils
+    map_data = gm.read_map(MAP_PATH).split('\n')
+    points = Game(MAP_PATH).get_points()
+    updates = [proto.decode_update(data) for data in sample_updates(200)]
+    client.role = 'cman'
+    client.renderer = client.MapRenderer(map_data, points, out=io.StringIO(), max_fps=0)
+    def run():
+        client.renderer.out.seek(0)
+        client.renderer.out.truncate()
+        for update in updates:
+            client.update_and_print_map(map_data, points, *update)
+    return run, len(updates)
+
+def measure(factory, repeat):
+    """Returns the best time per operation in nanoseconds."""
+    with contextlib.redirect_stdout(io.StringIO()):  # Game.restart_game prints
+        run, ops = factory()
+        timer = timeit.Timer(run)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number / ops * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the game, encoding and rendering hot paths")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare against a JSON baseline and flag regressions")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="relative slowdown that counts as a regression")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default="", help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    for name, factory in benchmarks.items():
+        if args.filter not in name:
+            continue
+        try:
+            ns = measure(factory, args.repeat)
+        except ImportError as e:
+            print(f"{name:50} skipped ({e})")
+            continue
+        results[name] = ns
+        line = f"{name:50} {ns:12.1f} ns/op"
+        if baseline is not None and name in baseline:
+            change = ns / baseline[name] - 1
+            line += f"  {change:+7.1%}"
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "results": results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import random
+from collections import deque
+from array import array
+from cman_game import Player, Direction
+
+NO_HOP = 0xFF  # next_hop value of unreachable cell pairs
+UNREACHABLE = 0xFFFF  # dist value of unreachable cell pairs
+MAX_CELLS = 4096  # Cells of the maps bots play, PathTables take 3 bytes per pair of cells
+WANDER = 0.1  # Chance of a random move, keeps two bots from repeating the same chase forever
+
+_tables = {}  # map content digest -> PathTables
+
+class PathTables:
+    """
+
+    All-pairs shortest paths between the cells of a map, computed once with a BFS from every
+    passable cell. For cells a and b, dist[a * n + b] is the number of moves from a to b and
+    next_hop[a * n + b] is the Direction of the first of them.
+
+    """
+    def __init__(self, game):
+        n = len(game.board)
+        neighbors = game.neighbors
+        self.n = n
+        self.dist = array('H', [UNREACHABLE]) * (n * n)
+        self.next_hop = bytearray([NO_HOP]) * (n * n)
+        sources = {cell for cell in range(n) if any(neighbors[4 * cell + d] >= 0 for d in Direction)}
+        for source in sources:
+            base = source * n
+            self.dist[base + source] = 0
+            queue = deque()
+            for d in Direction:
+                cell = neighbors[4 * source + d]
+                if cell >= 0 and self.dist[base + cell] == UNREACHABLE:
+                    self.dist[base + cell] = 1
+                    self.next_hop[base + cell] = d
+                    queue.append(cell)
+            while queue:
+                cell = queue.popleft()
+                hop = self.next_hop[base + cell]
+                dist = self.dist[base + cell] + 1
+                for d in Direction:
+                    nxt = neighbors[4 * cell + d]
+                    if nxt >= 0 and self.dist[base + nxt] == UNREACHABLE:
+                        self.dist[base + nxt] = dist
+                        self.next_hop[base + nxt] = hop
+                        queue.append(nxt)
+
+def get_path_tables(game):
+    """
+
+    Returns the PathTables of a game's map, computing them only the first time a map is seen.
+
+    Parameters:
+
+    game (Game): Any game instance played on the map
+
+    """
+    tables = _tables.get(game.map.digest)
+    if tables is None:
+        tables = _tables[game.map.digest] = PathTables(game)
+    return tables
+
+def random_move(game, cell):
+    """Returns a random Direction leading from cell to a passable cell, or None if there is none."""
+    options = [d for d in Direction if game.neighbors[4 * cell + d] >= 0]
+    return random.choice(options) if options else None
+
+class SpiritBot:
+    """Chases Cman along a shortest path."""
+
+    def __init__(self, game):
+        self.tables = get_path_tables(game)
+
+    def choose_move(self, game):
+        """
+
+        Returns:
+
+        Direction: The next move for the Spirit, or None if Cman cannot be reached
+
+        """
+        cman, spirit = game.cur_cells
+        if random.random() < WANDER:
+            return random_move(game, spirit)
+        hop = self.tables.next_hop[spirit * self.tables.n + cman]
+        return None if hop == NO_HOP else Direction(hop)
+
+class CmanBot:
+    """Heads for the nearest point the Spirit cannot reach first, fleeing when the Spirit is close."""
+
+    def __init__(self, game):
+        self.tables = get_path_tables(game)
+        self.point_cells = [(i * game.board_dims[1] + j, bit) for (i, j), bit in game.point_index.items()]
+
+    def choose_move(self, game):
+        """
+
+        Returns:
+
+        Direction: The next move for Cman, or None if no point is reachable
+
+        """
+        n = self.tables.n
+        dist, next_hop = self.tables.dist, self.tables.next_hop
+        cman, spirit = game.cur_cells
+        if random.random() < WANDER:
+            return random_move(game, cman)
+        if spirit >= 0 and dist[spirit * n + cman] <= 2:
+            # Step to the neighbor farthest from the Spirit
+            options = [(dist[spirit * n + nxt], d) for d in Direction
+                       if (nxt := game.neighbors[4 * cman + d]) >= 0 and nxt != spirit]
+            if options:
+                return Direction(max(options)[1])
+        collected = game.get_collected_mask()
+        best = None
+        for cell, bit in self.point_cells:
+            if (collected >> bit) & 1:
+                continue
+            mine = dist[cman * n + cell]
+            safe = spirit < 0 or dist[spirit * n + cell] > mine
+            candidate = (not safe, mine, cell)
+            if best is None or candidate < best:
+                best = candidate
+        if best is None or best[1] == UNREACHABLE:
+            return None
+        hop = next_hop[cman * n + best[2]]
+        return None if hop == NO_HOP else Direction(hop)
+
+BOTS = {Player.CMAN: CmanBot, Player.SPIRIT: SpiritBot}
@@ -2,12 +2,19 @@ import socket
 import time
 import sys
 import select
-from cman_utils import get_pressed_keys, clear_print, _flush_input  # Importing utils functions
-from cman_game import Game, Player, Direction  # Assuming these classes are defined in game_logic.py
-from cman_game_map import read_map  # Importing read_map function from game_map.py
+from collections import deque
+from cman_utils import get_pressed_keys, start_key_listener  # Importing utils functions
+from cman_game import Game, Player, Direction, State, MAX_ATTEMPTS  # Assuming these classes are defined in game_logic.py
+from cman_game_map import load_map  # Compiled map, parsed once and shared with the predictor's Game
+import cman_protocol as proto
 # Constants
 TIMEOUT = 0.01
+MAX_FPS = 30  # Upper bound on how often the map is redrawn
+RECV_BATCH = 256  # Datagrams read per loop iteration at most, keeps the keyboard responsive under a flood
 SERVER_PORT = 1337
+ROOM_ID = 0  # Room to join on the server
+MAP_PATH = 'map.txt'  # Map the server plays, drawn locally
+MAX_REDIRECTS = 8  # Redirects followed before giving up, guards against misconfigured relay loops
 POINT_CHAR = 'P'
 FREE_CHAR = 'F'
 CMAN_CHAR = 'C'
@@ -20,19 +27,39 @@ client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 # Global variables
 role = None  # Player's role in the game
 game_active = True  # Game status
+predict = False  # Whether to predict our own moves instead of waiting for the server
+predictor = None  # Predictor of the local player's moves, None unless prediction is enabled
+redirects = 0  # Redirects followed so far
+last_sent = 0  # Time of our last message, the server evicts clients that stay quiet for too long
 
 def send_message(message):
     """Send a message to the server."""
+    global last_sent
     client_socket.sendto(message, (addr, SERVER_PORT))
+    last_sent = time.monotonic()
 
 def handle_join(role):
     """Send a join request to the server."""
-    message = bytes([0x00, role])  # 0x00 is the JOIN opcode, role is the second byte
+    # 0x00 is the JOIN opcode, role is the second byte, then the room ID and the join flags
+    message = bytes([0x00, role]) + ROOM_ID.to_bytes(2, 'big') + bytes([proto.JOIN_SEQUENCED | proto.JOIN_REDIRECT])
     send_message(message)
 
+def follow_redirect(data, role):
+    """Join again at the relay a 0x8D message sends us to."""
+    global addr, SERVER_PORT, redirects
+    redirects += 1
+    if redirects > MAX_REDIRECTS:
+        print("Too many redirects.")
+        exit(1)
+    addr, SERVER_PORT = proto.decode_redirect(data)
+    handle_join(role)
+
 def handle_move(direction):
     """Send a player movement request to the server."""
     message = bytes([0x01, direction.value])  # 0x01 is the MOVE opcode, direction is the second byte
+    if predictor is not None:
+        # Tag the move so the server's acknowledgement tells when its updates include it
+        message += predictor.move(direction).to_bytes(2, 'big')
     send_message(message)
 
 def handle_quit():
@@ -40,6 +67,173 @@ def handle_quit():
     message = bytes([0x0F])  # 0x0F is the QUIT opcode
     send_message(message)
 
+class MapRenderer:
+    """
+    Draws the game map in place, rewriting only the cells and status lines that changed.
+
+    The first frame (and the first one after invalidate()) clears the screen and draws
+    everything; later frames move the cursor to each changed cell with ANSI escapes.
+    Every frame is emitted with a single write, and frames requested faster than
+    max_fps are coalesced so only the newest state is drawn.
+    """
+    MAP_TOP = 4  # Screen row of the first map row, below the blank line, the title and the border
+
+    def __init__(self, map_data, points, out=None, max_fps=MAX_FPS):
+        self.out = out if out is not None else sys.stdout
+        self.min_interval = 1 / max_fps if max_fps else 0
+        self.rows, self.cols = len(map_data), len(map_data[0])
+        # What an empty cell looks like, players removed and points not yet collected
+        glyphs = {FREE_CHAR: ' ', CMAN_CHAR: ' ', SPIRIT_CHAR: ' ', WALL_CHAR: '#', POINT_CHAR: 'o'}
+        self.base = [[glyphs[x] for x in line] for line in map_data]
+        self.point_cells = sorted(points.keys())
+        self.point_bits = {cell: 1 << i for i, cell in enumerate(self.point_cells)}
+        self.last_draw = 0
+        self.pending = None  # Newest state not drawn yet
+        self.invalidate()
+
+    def invalidate(self):
+        """Force the next frame to redraw the whole screen, e.g. after other output scrolled it."""
+        self.screen = None  # Rows of glyphs currently on the terminal
+        self.status = []
+        self.drawn = (0, proto.NO_COORDS, proto.NO_COORDS)  # Collected mask and player coords on screen
+
+    def render(self, freeze, c_coords, s_coords, attempts, collected):
+        """Queue a game state to be drawn and draw it unless the frame rate cap says to wait."""
+        self.pending = (freeze, c_coords, s_coords, attempts, collected)
+        self.flush()
+
+    def flush(self, force=False):
+        """Draw the pending state if there is one and the frame budget allows it."""
+        if self.pending is None:
+            return
+        now = time.monotonic()
+        if not force and self.screen is not None and now - self.last_draw < self.min_interval:
+            return
+        self.last_draw = now
+        freeze, c_coords, s_coords, attempts, collected = self.pending
+        self.pending = None
+        if self.screen is None:
+            buf = self._draw_full(c_coords, s_coords, collected)
+        else:
+            buf = self._draw_changes(c_coords, s_coords, collected)
+        self._draw_status(buf, freeze, c_coords, s_coords, attempts, collected)
+        self.drawn = (collected, c_coords, s_coords)
+        self.out.write(''.join(buf))
+        self.out.flush()
+
+    def _glyph(self, cell, c_coords, s_coords, collected):
+        if cell == c_coords:
+            return CMAN_CHAR
+        if cell == s_coords:
+            return SPIRIT_CHAR
+        bit = self.point_bits.get(cell)
+        if bit is not None and collected & bit:
+            return ' '
+        return self.base[cell[0]][cell[1]]
+
+    def _draw_full(self, c_coords, s_coords, collected):
+        self.screen = [row[:] for row in self.base]
+        changed = self.point_bits.keys() | {c_coords, s_coords}
+        for cell in changed:
+            if cell[0] < self.rows and cell[1] < self.cols:
+                self.screen[cell[0]][cell[1]] = self._glyph(cell, c_coords, s_coords, collected)
+        border = "+" + "-" * (self.cols * 2 - 1) + "+\n"
+        buf = ["\033[H\033[J \nGame Map:\n", border]
+        buf.extend("| " + " ".join(row) + " |\n" for row in self.screen)
+        buf.append(border)
+        return buf
+
+    def _draw_changes(self, c_coords, s_coords, collected):
+        old_collected, old_c, old_s = self.drawn
+        changed = {old_c, old_s, c_coords, s_coords}
+        flipped = collected ^ old_collected
+        while flipped:
+            low = flipped & -flipped
+            changed.add(self.point_cells[low.bit_length() - 1])
+            flipped ^= low
+        buf = []
+        for cell in changed:
+            r, c = cell
+            if r >= self.rows or c >= self.cols:
+                continue  # Absent player
+            glyph = self._glyph(cell, c_coords, s_coords, collected)
+            if self.screen[r][c] != glyph:
+                self.screen[r][c] = glyph
+                buf.append(f"\033[{self.MAP_TOP + r};{3 + 2 * c}H{glyph}")
+        return buf
+
+    def _draw_status(self, buf, freeze, c_coords, s_coords, attempts, collected):
+        remaining_points = len(self.point_cells) - bin(collected).count('1')
+        status = ["", "Game Status:"]
+        if c_coords == proto.NO_COORDS or s_coords == proto.NO_COORDS:
+            status.append("  Waiting for another player.")
+        status.append(f"  You are playing as: {role}")
+        status.append(f"  Freeze: {'Yes' if freeze else 'No'}")
+        status.append(f"  Cman Caught Attempts: {attempts}")
+        status.append(f"  Remaining Points: {remaining_points}")
+        status.append(f"  CMAN has {len(self.point_cells) - remaining_points} points.")
+        top = self.MAP_TOP + self.rows + 1
+        for i, line in enumerate(status):
+            if i >= len(self.status) or self.status[i] != line:
+                buf.append(f"\033[{top + i};1H{line}\033[K")
+        if len(status) < len(self.status):
+            buf.append(f"\033[{top + len(status)};1H\033[J")
+        self.status = status
+        # Leave the cursor below the frame so other messages do not overwrite it
+        buf.append(f"\033[{top + len(status) + 1};1H")
+
+class Predictor:
+    """
+    Client side prediction of the local player's moves.
+
+    Moves are applied to a local Game, with the same rules the server uses, as soon as they
+    are sent, and tagged with increasing input IDs. Every authoritative update resets the
+    local game to the server's state and replays the moves the server has not acknowledged
+    yet, so a misprediction is rolled back as soon as the server's view arrives.
+    """
+    def __init__(self, cmap, player):
+        self.game = Game(cmap)
+        self.player = player
+        self.last_id = 0  # ID of the last move sent
+        self.pending = deque()  # (input_id, direction) of moves the server has not acknowledged
+        self.server = None  # Last authoritative SequencedState, None until the first one arrives
+
+    def move(self, direction):
+        """Predict a move of the local player and return the input ID to send with it."""
+        self.last_id = proto.next_input_id(self.last_id)
+        self.pending.append((self.last_id, direction))
+        if self.server is not None:
+            self.game.apply_move(self.player, direction)
+        return self.last_id
+
+    def reconcile(self, state):
+        """Rebase the prediction on an authoritative SequencedState."""
+        self.server = state
+        pending = self.pending
+        while pending and not proto.seq_newer(pending[0][0], state.ack):
+            pending.popleft()
+        self.game.load_progress([state.c_coords, state.s_coords], MAX_ATTEMPTS - state.attempts, state.collected,
+                                State.WAIT if state.freeze else State.PLAY)
+        for _, direction in pending:
+            self.game.apply_move(self.player, direction)
+
+    def view(self):
+        """
+        Returns:
+        tuple: The predicted (freeze, cman coords, spirit coords, attempts, collected) to draw
+        """
+        state = self.server
+        game = self.game
+        c_coords, s_coords = game.get_current_players_coords()
+        if state.c_coords == proto.NO_COORDS:
+            c_coords = state.c_coords
+        if state.s_coords == proto.NO_COORDS:
+            s_coords = state.s_coords
+        lives, _ = game.get_game_progress()
+        return state.freeze, c_coords, s_coords, MAX_ATTEMPTS - lives, game.get_collected_mask()
+
+renderer = None  # MapRenderer of the running client
+
 def update_and_print_map(map_data, points, freeze, c_coords, s_coords, attempts, collected):
     """
     Updates the map with the current game state and prints it.
@@ -50,124 +244,109 @@ def update_and_print_map(map_data, points, freeze, c_coords, s_coords, attempts,
     - c_coords (tuple): Coordinates of Cman (row, col) or None if not active
     - s_coords (tuple): Coordinates of Spirit (row, col) or None if not active
     - attempts (int): Number of times Cman was caught by Spirit
-    - collected (list[int]): 40-bit list of collected points (1: collected, 0: not collected)
+    - collected (int): Bitmask of collected points, bit i set if the i-th point (sorted by coordinates) was collected
     """
-    # Copy the map to update without modifying the original
-    updated_map = [list(line) for line in map_data]
-    # Update collected points
-    rows, cols = len(updated_map), len(updated_map[0])
-    
-    for r in range(rows):
-        for c in range(cols):
-            if updated_map[r][c] in {CMAN_CHAR, SPIRIT_CHAR}:
-                updated_map[r][c] = FREE_CHAR
+    global renderer
+    if collected.bit_length() > len(points):
+        print(f"\nThe server plays a map with more points than {MAP_PATH}, pass its map with --map. Exiting.")
+        sys.exit(1)
+    if renderer is None:
+        renderer = MapRenderer(map_data, points)
+    renderer.render(freeze, c_coords, s_coords, attempts, collected)
 
-    
-    for i, point in enumerate(sorted(points.keys())):
-        if collected[i] == 1:
-            updated_map[point[0]][point[1]] = ' '
-    
-    # Update player positions
-    if c_coords != (0xFF, 0xFF):  # Check if Cman is active
-        updated_map[c_coords[0]][c_coords[1]] = CMAN_CHAR
-
-    if s_coords != (0xFF, 0xFF):  # Check if Spirit is active
-        updated_map[s_coords[0]][s_coords[1]] = SPIRIT_CHAR
-
-    # replace free space with ' '
-    for i in range(len(updated_map)):
-        updated_map[i] = [x if x != FREE_CHAR else ' ' for x in updated_map[i]]
-        updated_map[i] = [x if x != WALL_CHAR else '#' for x in updated_map[i]]
-        updated_map[i] = [x if x != POINT_CHAR else 'o' for x in updated_map[i]]
-        
-  
-    
-    # Print the updated map
-    clear_print(" ")
-    print("Game Map:")
-    print("+" + "-" * (cols * 2 - 1) + "+")
-    for row in updated_map:
-        print("| " + " ".join(row) + " |")
-    print("+" + "-" * (cols * 2 - 1) + "+")
-    
-    # Print the game status
-    print("\nGame Status:")
-    if c_coords == (0xFF, 0xFF) or s_coords == (0xFF, 0xFF):
-        print("  Waiting for another player.")
-    print(f"  You are playing as: {role}")
-    print(f"  Freeze: {'Yes' if freeze else 'No'}")
-    print(f"  Cman Caught Attempts: {attempts}")
-    remaining_points = collected.count(0)
-    print(f"  Remaining Points: {remaining_points}")
-    print(f"  CMAN has {len(points) - remaining_points} points.\n")
 
+def draw_state(map_data, points, state, latest):
+    """
+    Draws the newest state received in an iteration of the main loop.
+
+    Parameters:
+    - state (SequencedState): The sequenced game state
+    - latest (bytes): The newest 0x80/0x84 message, or None to draw the sequenced state
+    """
+    if latest is not None:
+        update_and_print_map(map_data, points, *proto.decode_update(latest))
+    elif predictor is not None:
+        predictor.reconcile(state)
+        update_and_print_map(map_data, points, *predictor.view())
+    else:
+        update_and_print_map(map_data, points, state.freeze, state.c_coords, state.s_coords,
+                             state.attempts, state.collected)
 
 def main():
-    global role, game_active
+    global role, game_active, predictor
     roles_dict = {'cman': 1, 'spirit': 2, 'watcher': 0}
-    map_data = read_map('map.txt').split('\n')
-    points = Game('map.txt').get_points()
+    cmap = load_map(MAP_PATH)
+    map_data = cmap.rows
+    points = cmap.point_index
+    state = proto.SequencedState()  # Latest sequenced game state received from the server
+    if predict and role != 'watcher':
+        predictor = Predictor(cmap, Player.CMAN if role == 'cman' else Player.SPIRIT)
     if role in roles_dict.keys():
+        start_key_listener()
         handle_join(roles_dict[role])  # Send join request
     else:
         print(f"Invalid role: {role}")
         exit(1)
     # Wait for server response
+    client_socket.setblocking(False)  # Every datagram queued by select() time is read in one go
     while True:
-        # Prepare the list of file descriptors to watch (socket and stdin)
-        
-        rlist, _, _ = select.select([client_socket], [], [], TIMEOUT)  # 1 second timeout
-        
-        for ready in rlist:
-            if ready == client_socket:
-                # Receive a message from the server
-            
-                data, addr = client_socket.recvfrom(1024)
-                
-                opcode = data[0]
-                #print(f"Received message with opcode {opcode}")
-                
-                # Handle game state update
-                if opcode == 0x80:  # Game state update (0x80)
-                    freeze = data[1]
-                    c_coords = (data[2], data[3])
-                    s_coords = (data[4], data[5])
-                    attempts = data[6]
-                    # unpack 5 bytes of collected to a list of 40 ints
-                    collected = []
-                    for i in range(7, 12):
-                        byte = data[i]
-                        for j in range(8):
-                            collected.append((byte >> j) & 1)
-                    
-                    update_and_print_map(map_data, points, freeze, c_coords, s_coords, attempts, collected)
-                    break
-                    
-                elif opcode == 0x8F:  # Game end (0x8F)
-                    winner = "CMAN" if data[1] == 1 else "Spirit"
-                    print(f"Game Over! The winner is {winner}")
-                    print(f"CMAN Score: {data[2]}")
-                    print(f"Spirit Score: {data[3]}")
-                    exit(0)
-                    break
-              
-                elif opcode == 0xFF:
-                    error_code = data[1]
-                    if error_code == 0x00:
-                        print("waiting for players")
-                    elif error_code == 0x01:
-                        print("Spirit cannot move yet, CMAN has to move first.")
-                    elif error_code == 0x03:
-                        print("CMAN already taken.")
-                        exit(1)
-                    elif error_code == 0x04:
-                        print("Spirit already taken.")
-                        exit(1)
-                    elif error_code == 0x05:
-                        print("Invalid role.")                        
-                        exit(1)
-                        
-            
+        rlist, _, _ = select.select([client_socket], [], [], TIMEOUT)
+
+        # Drain the socket, keeping only the newest state, so a slow terminal skips frames instead of lagging
+        latest = None  # Newest 0x80/0x84 message received, decoded only once the socket is empty
+        advanced = False  # Whether the sequenced state advanced
+        for _ in range(RECV_BATCH if rlist else 0):
+            try:
+                data, _ = client_socket.recvfrom(65536)  # State messages of big maps exceed 1024 bytes
+            except BlockingIOError:
+                break
+            opcode = data[0]
+
+            if opcode == 0x80 or opcode == proto.WIDE_UPDATE:  # Game state update (0x80, or 0x84 on big maps)
+                latest = data
+
+            elif opcode == proto.KEYFRAME or opcode == proto.DELTA:  # Sequenced game state update
+                # Every delta builds on the previous one, so all of them are applied, only drawing is skipped
+                advanced |= state.apply(data)
+
+            elif opcode == proto.REDIRECT:  # Watch the match on a spectator relay instead
+                follow_redirect(data, roles_dict[role])
+
+            elif opcode == 0x8F:  # Game end (0x8F)
+                if latest is not None or advanced:
+                    draw_state(map_data, points, state, latest)
+                if renderer is not None:
+                    renderer.flush(force=True)
+                winner = "CMAN" if data[1] == 1 else "Spirit"
+                print(f"Game Over! The winner is {winner}")
+                print(f"CMAN Score: {data[2]}")
+                print(f"Spirit Score: {data[3]}")
+                exit(0)
+
+            elif opcode == 0xFF:
+                error_code = data[1]
+                if renderer is not None:
+                    renderer.invalidate()  # The message below scrolls the frame
+                if error_code == 0x00:
+                    print("waiting for players")
+                elif error_code == 0x01:
+                    print("Spirit cannot move yet, CMAN has to move first.")
+                elif error_code == 0x03:
+                    print("CMAN already taken.")
+                    exit(1)
+                elif error_code == 0x04:
+                    print("Spirit already taken.")
+                    exit(1)
+                elif error_code == 0x05:
+                    print("Invalid role.")
+                    exit(1)
+
+        if latest is not None or advanced:
+            draw_state(map_data, points, state, latest)
+        if renderer is not None:
+            renderer.flush()  # Draw a state held back by the frame rate cap
+        if time.monotonic() - last_sent >= proto.KEEPALIVE_INTERVAL:
+            send_message(bytes([proto.KEEPALIVE]))
         keys = get_pressed_keys()
 
         if keys != []:
@@ -184,6 +363,8 @@ def main():
                     handle_move(Direction.DOWN)
                 elif 'd' in keys:
                     handle_move(Direction.RIGHT)
+                if predictor is not None and predictor.server is not None:
+                    update_and_print_map(map_data, points, *predictor.view())
             else:
                 print("Watcher cannot move.")    
 
@@ -191,6 +372,16 @@ def main():
 
 if __name__ == "__main__":
     # get args from command line
+    predict = '--predict' in sys.argv
+    if predict:
+        sys.argv.remove('--predict')
+    if '--map' in sys.argv:
+        i = sys.argv.index('--map')
+        if i + 1 == len(sys.argv):
+            print("Missing map path. Exiting.")
+            sys.exit(1)
+        MAP_PATH = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
     try :
         role = sys.argv[1]
         addr = sys.argv[2]
@@ -208,4 +399,12 @@ if __name__ == "__main__":
         except ValueError:
             print("Invalid port. Exiting.")
             sys.exit(1)
+
+    if len(sys.argv) > 4:
+        try :
+            ROOM_ID = int(sys.argv[4])
+            assert 0 <= ROOM_ID < 2**16
+        except (ValueError, AssertionError):
+            print("Invalid room. Exiting.")
+            sys.exit(1)
     main()
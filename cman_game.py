@@ -23,6 +23,9 @@ class State(IntEnum):
 	WIN = 3		# Game ended
 
 class Game():
+	__slots__ = ('map', 'board', 'board_dims', 'neighbors', 'cell_coords', 'cell_point', 'start_coords', 'start_cells',
+				 'points', 'point_index', 'win_score', 'cur_coords', 'cur_cells', 'score', 'collected', 'lives', 'state', 'winner')
+
 	def __init__(self, map_path):
 		"""
 
@@ -30,21 +33,27 @@ class Game():
 
 		Parameters:
 
-		map_path (str): a path to the textual map file
+		map_path (str or CompiledMap): a path to the textual map file, or the map compiled from it
 
 		"""
-		assert os.path.isfile(map_path), "map file does not exist."
-		self.board = gm.read_map(map_path).split('\n')
-		self.board_dims = (len(self.board), len(self.board[0]))
-
-		self.start_coords = []
-		for p_char in gm.PLAYER_CHARS:
-			start_row = [p_char in row for row in self.board].index(True)
-			self.start_coords.append((start_row, self.board[start_row].index(p_char)))
-
-		self.points = {(i,j):1 for i in range(self.board_dims[0])
-							   for j in range(self.board_dims[1])
-							   if self.board[i][j] == gm.POINT_CHAR}
+		if isinstance(map_path, gm.CompiledMap):
+			cmap = map_path
+		else:
+			assert os.path.isfile(map_path), "map file does not exist."
+			cmap = gm.load_map(map_path)
+		# Map tables are shared by every game on the same map, see cman_game_map.CompiledMap
+		self.map = cmap
+		self.board_dims = cmap.board_dims
+		self.board = cmap.board
+		self.cell_coords = cmap.cell_coords
+		self.neighbors = cmap.neighbors
+		self.cell_point = cmap.cell_point
+		self.start_coords = list(cmap.start_coords)
+		self.start_cells = list(cmap.start_cells)
+		self.point_index = cmap.point_index
+		self.points = dict.fromkeys(cmap.point_index, 1)
+		# Maps with fewer points than WIN_SCORE are won by collecting all of them
+		self.win_score = min(WIN_SCORE, len(cmap.point_index))
 		self.restart_game()
 
 	def restart_game(self):
@@ -54,10 +63,12 @@ class Game():
 
 		"""
 		self.cur_coords = self.start_coords[::]
+		self.cur_cells = self.start_cells[::]
 		print(self.cur_coords)
 		self.score = 0
 		for p in self.points.keys():
 			self.points[p] = 1
+		self.collected = 0
 		self.lives = MAX_ATTEMPTS
 		self.state = State.WAIT
 		self.winner = None
@@ -69,6 +80,7 @@ class Game():
 
 		"""
 		self.cur_coords = self.start_coords[::]
+		self.cur_cells = self.start_cells[::]
 		self.state = State.START
 
 	def get_current_players_coords(self):
@@ -103,6 +115,43 @@ class Game():
 		"""
 		return self.points
 
+	def get_collected_mask(self):
+		"""
+		
+		Returns:
+
+		int: A bitmask of the collected points in this game instance, bit i is set if the i-th point (ordered lexicographically by coordinates) was collected
+
+		"""
+		return self.collected
+
+	def load_progress(self, coords, lives, collected, state):
+		"""
+		
+		Overwrites the progress of this game instance, e.g. with an authoritative copy received from a server.
+
+		Parameters:
+
+		coords (list(tuple(int, int))): The coordinates of each player
+
+		lives (int): The ammount of lives left for Cman
+
+		collected (int): A bitmask of the collected points, see get_collected_mask()
+
+		state (State): The new game state
+
+		"""
+		self.cur_coords = list(coords)
+		height, width = self.board_dims
+		self.cur_cells = [i * width + j if i < height and j < width else -1 for i, j in self.cur_coords]
+		self.lives = lives
+		self.collected = collected
+		for p, i in self.point_index.items():
+			self.points[p] = 0 if (collected >> i) & 1 else 1
+		self.score = bin(collected).count('1')
+		self.state = state
+		self.winner = None
+
 	def get_winner(self):
 		"""
 		
@@ -170,27 +219,80 @@ class Game():
 		if not self.can_move(player):
 			return False
 
-		p_coords = self.cur_coords[player]
-		dr = -1 if direction == Direction.UP else 1 if direction == Direction.DOWN else 0
-		dc = -1 if direction == Direction.LEFT else 1 if direction == Direction.RIGHT else 0
-		next_coords = (p_coords[0] + dr, p_coords[1] + dc)
-
-		if any(x < 0 for x in next_coords) or next_coords[0] >= self.board_dims[0] or next_coords[1] >= self.board_dims[1]:
+		cell = self.cur_cells[player]
+		if cell < 0:
 			return False
-		if self.board[next_coords[0]][next_coords[1]] not in gm.PASS_CHARS:
+		next_cell = self.neighbors[4 * cell + direction]
+		if next_cell < 0:
 			return False
 		else:
 			self.state = State.PLAY
+			next_coords = self.cell_coords[next_cell]
+			self.cur_cells[player] = next_cell
 			self.cur_coords[player] = next_coords
-			if player == Player.CMAN and next_coords in self.points.keys():
-				self.score += self.points[next_coords]
-				self.points[next_coords] = 0
-				if self.score >= WIN_SCORE:
-					self.declare_winner(Player.CMAN)
-			if (player == Player.CMAN and next_coords in self.cur_coords[1:]) or (player != Player.CMAN and next_coords == self.cur_coords[0]):
+			if player == Player.CMAN:
+				bit = self.cell_point[next_cell]
+				if bit >= 0 and not (self.collected >> bit) & 1:
+					self.score += 1
+					self.points[next_coords] = 0
+					self.collected |= 1 << bit
+					if self.score >= self.win_score:
+						self.declare_winner(Player.CMAN)
+			if (player == Player.CMAN and next_cell == self.cur_cells[1]) or (player != Player.CMAN and next_cell == self.cur_cells[0]):
 				self.lives -= 1
 				if self.lives <= 0:
 					self.declare_winner(Player.SPIRIT)
 				else:
 					self.next_round()
 			return True
+
+	def apply_moves(self, moves):
+		"""
+		
+		Applies a sequence of moves with the same effect as calling apply_move() for each, without its per-call overhead.
+
+		Parameters:
+
+		moves (bytes): One move per byte, the player in the high bits and the direction in the low two: player << 2 | direction
+
+		Returns:
+
+		int: The number of moves that changed the game state
+
+		"""
+		neighbors = self.neighbors
+		cell_point = self.cell_point
+		cell_coords = self.cell_coords
+		play, start = State.PLAY, State.START  # Enum attribute lookups are slow in a loop
+		applied = 0
+		for move in moves:
+			player = move >> 2
+			state = self.state
+			if state != play and (state != start or player):
+				continue
+			cells = self.cur_cells
+			cell = cells[player]
+			if cell < 0:
+				continue
+			next_cell = neighbors[4 * cell + (move & 3)]
+			if next_cell < 0:
+				continue
+			applied += 1
+			self.state = play
+			cells[player] = next_cell
+			self.cur_coords[player] = cell_coords[next_cell]
+			if not player:  # Player.CMAN
+				bit = cell_point[next_cell]
+				if bit >= 0 and not (self.collected >> bit) & 1:
+					self.score += 1
+					self.points[cell_coords[next_cell]] = 0
+					self.collected |= 1 << bit
+					if self.score >= self.win_score:
+						self.declare_winner(Player.CMAN)
+			if next_cell == cells[1 - player]:
+				self.lives -= 1
+				if self.lives <= 0:
+					self.declare_winner(Player.SPIRIT)
+				else:
+					self.next_round()
+		return applied
@@ -1,3 +1,10 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
 CMAN_CHAR = 'C'
 SPIRIT_CHAR = 'S'
 PLAYER_CHARS = [CMAN_CHAR, SPIRIT_CHAR]
@@ -5,7 +12,20 @@ POINT_CHAR = 'P'
 FREE_CHAR = 'F'
 PASS_CHARS = [CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, FREE_CHAR]
 WALL_CHAR = 'W'
-MAX_POINTS = 40
+MAX_DIM = 0xFFFF  # Rows and columns of a map, coordinates are sent as 16 bit values and 0xFFFF marks absent players
+MAX_POINTS = 0x10000  # Points of a map, deltas send the indices of collected points as 16 bit values
+
+# Cell offsets of the moves in cman_game.Direction order: UP, LEFT, DOWN, RIGHT
+DIRECTION_STEPS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+
+# Compiled map file: header, then the board chars padded to 4 bytes, then the native
+# int32 arrays neighbors[4 * cells] and cell_point[cells]
+COMPILED_MAGIC = b'CMAP'
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct('<4sI32s4I')  # magic, version, content digest, height, width, cman and spirit start cells
+
+_compiled = {}  # content digest -> CompiledMap
+_paths = {}  # (path, mtime, size) -> CompiledMap loaded from that file
 
 def read_map(path):
     """
@@ -19,21 +39,194 @@ def read_map(path):
     """
     with open(path, 'r') as f:
         map_data = f.read()
+    check_map(map_data)
+    return map_data
+
+def check_map(map_data):
+    """
+
+    Asserts that map data is valid.
+
+    Parameters:
+
+    map_data (str): the textual map
+
+    """
+    map_chars = set(map_data)
+    assert map_chars.issubset({CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, WALL_CHAR, FREE_CHAR, '\n'}), "invalid char in map."
+    assert map_data.count(CMAN_CHAR) == 1, "Map needs to have a single C-Man starting point."
+    assert map_data.count(SPIRIT_CHAR) == 1, "Map needs to have a single Spirit starting point."
+    assert map_data.count(POINT_CHAR) > 0, "Map needs to have score points."
+    assert map_data.count(POINT_CHAR) <= MAX_POINTS, "Map has too many score points."
+
+    map_lines = map_data.split('\n')
+    assert all(len(line) == len(map_lines[0]) for line in map_lines), "map is not square."
+    assert len(map_lines) < MAX_DIM, "map is too tall"
+    assert len(map_lines[0]) < MAX_DIM, "map is too wide"
+
+    sbc = all(line.startswith(WALL_CHAR) and line.endswith(WALL_CHAR) for line in map_lines)
+    tbc = map_lines[0] == WALL_CHAR*len(map_lines[0]) and map_lines[-1] == WALL_CHAR*len(map_lines[-1])
+    bbc = map_lines[0] == WALL_CHAR*len(map_lines[0]) and map_lines[-1] == WALL_CHAR*len(map_lines[-1])
+    assert sbc and tbc and bbc, "map border is open."
+
+class CompiledMap:
+    """
+
+    A validated map with the lookup tables games play on, built once per map content and shared,
+    read-only, by every game, room and client using that map.
+
+    Cells are numbered row-major, cell i is at (i // width, i % width).
+
+    """
+    __slots__ = ('digest', 'rows', 'board', 'board_dims', 'cell_coords', 'neighbors', 'cell_point',
+                 'start_cells', 'start_coords', 'point_index')
+
+    def __init__(self, digest, board, board_dims, neighbors, cell_point, start_cells):
+        height, width = board_dims
+        self.digest = digest  # SHA-256 of the map text
+        self.board = board  # Map char of every cell
+        self.board_dims = board_dims
+        self.rows = [bytes(board[i * width:(i + 1) * width]).decode('ascii') for i in range(height)]
+        self.cell_coords = tuple((i, j) for i in range(height) for j in range(width))
+        # neighbors[4 * cell + direction] is the passable cell reached by moving in direction, or -1
+        self.neighbors = neighbors
+        # cell_point[cell] is the bit of the point on that cell in collected masks, or -1 if there is none
+        self.cell_point = cell_point
+        self.start_cells = tuple(start_cells)
+        self.start_coords = tuple(self.cell_coords[cell] for cell in start_cells)
+        # Bit of each point in the collected mask, points ordered lexicographically by coordinates
+        self.point_index = {self.cell_coords[cell]: bit for cell, bit in enumerate(cell_point) if bit >= 0}
+
+def map_digest(map_data):
+    """Returns the SHA-256 digest that keys the compiled form of map data."""
+    return hashlib.sha256(map_data.encode('ascii')).digest()
+
+def compile_map(map_data):
+    """
+
+    Validates and compiles textual map data, once per distinct content.
+
+    Parameters:
+
+    map_data (str): the textual map
+
+    Returns:
+
+    CompiledMap: The compiled map, shared with every other caller compiling the same content
 
-        map_chars = set(map_data)
-        assert map_chars.issubset({CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, WALL_CHAR, FREE_CHAR, '\n'}), "invalid char in map."
-        assert map_data.count(CMAN_CHAR) == 1, "Map needs to have a single C-Man starting point."
-        assert map_data.count(SPIRIT_CHAR) == 1, "Map needs to have a single Spirit starting point."
-        assert map_data.count(POINT_CHAR) == MAX_POINTS, f"Map needs to have {MAX_POINTS} score points."
+    """
+    digest = map_digest(map_data)
+    cmap = _compiled.get(digest)
+    if cmap is not None:
+        return cmap
+    check_map(map_data)
+    rows = map_data.split('\n')
+    height, width = len(rows), len(rows[0])
+    board = ''.join(rows).encode('ascii')
+    passable = {ord(c) for c in PASS_CHARS}
+    neighbors = []
+    for cell in range(height * width):
+        i, j = divmod(cell, width)
+        for dr, dc in DIRECTION_STEPS:
+            inside = 0 <= i + dr < height and 0 <= j + dc < width
+            nxt = cell + dr * width + dc
+            neighbors.append(nxt if inside and board[nxt] in passable else -1)
+    cell_point = [-1] * len(board)
+    for bit, cell in enumerate(i for i, c in enumerate(board) if c == ord(POINT_CHAR)):
+        cell_point[cell] = bit  # Row-major order is lexicographic order of the coordinates
+    start_cells = [board.index(ord(p_char)) for p_char in PLAYER_CHARS]
+    cmap = _compiled[digest] = CompiledMap(digest, board, (height, width), tuple(neighbors), tuple(cell_point),
+                                           start_cells)
+    return cmap
+
+def save_compiled(cmap, path):
+    """
+
+    Writes a compiled map in the binary form read by load_compiled().
+
+    Parameters:
+
+    cmap (CompiledMap): the map to write
+
+    path (str): path of the binary file
+
+    """
+    height, width = cmap.board_dims
+    board = bytes(cmap.board)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, cmap.digest, height, width, *cmap.start_cells))
+        f.write(board + bytes(-len(board) % 4))
+        f.write(array('i', cmap.neighbors).tobytes())
+        f.write(array('i', cmap.cell_point).tobytes())
+    os.replace(path + '.tmp', path)  # Readers never see a partly written file
+
+def load_compiled(path, digest=None):
+    """
+
+    Maps a compiled map file into memory, its tables are used in place without being parsed.
+
+    Parameters:
 
-        map_lines = map_data.split('\n')
-        assert all(len(line) == len(map_lines[0]) for line in map_lines), "map is not square."
-        assert len(map_lines) < 2**8, "map is too tall"
-        assert len(map_lines[0]) < 2**8, "map is too wide"
+    path (str): path of a file written by save_compiled()
 
-        sbc = all(line.startswith(WALL_CHAR) and line.endswith(WALL_CHAR) for line in map_lines)
-        tbc = map_lines[0] == WALL_CHAR*len(map_lines[0]) and map_lines[-1] == WALL_CHAR*len(map_lines[-1])
-        bbc = map_lines[0] == WALL_CHAR*len(map_lines[0]) and map_lines[-1] == WALL_CHAR*len(map_lines[-1])
-        assert sbc and tbc and bbc, "map border is open."
+    digest (bytes): expected content digest, a file compiled from other content is rejected
 
-        return map_data
\ No newline at end of file
+    Returns:
+
+    CompiledMap: The map, or None if the file is missing, stale or was written on an incompatible machine
+
+    """
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mm) < COMPILED_HEADER.size or sys.byteorder != 'little':
+        return None
+    magic, version, file_digest, height, width, c_start, s_start = COMPILED_HEADER.unpack_from(mm)
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION or (digest is not None and file_digest != digest):
+        return None
+    if file_digest in _compiled:
+        return _compiled[file_digest]
+    cells = height * width
+    board_at = COMPILED_HEADER.size
+    neighbors_at = board_at + cells + -cells % 4
+    cell_point_at = neighbors_at + 16 * cells
+    if len(mm) != cell_point_at + 4 * cells:
+        return None
+    view = memoryview(mm)
+    cmap = _compiled[file_digest] = CompiledMap(file_digest, view[board_at:board_at + cells], (height, width),
+                                                view[neighbors_at:cell_point_at].cast('i'),
+                                                view[cell_point_at:].cast('i'), (c_start, s_start))
+    return cmap
+
+def load_map(path, cache_path=None):
+    """
+
+    Returns the compiled map of a textual map file, compiling it only if no game in this process
+    did so yet and no up to date compiled file exists at cache_path.
+
+    Parameters:
+
+    path (str): path to the textual map file
+
+    cache_path (str): optional path of a compiled copy, written if missing or stale
+
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    cmap = _paths.get(key)
+    if cmap is not None:
+        return cmap
+    with open(path, 'r') as f:
+        map_data = f.read()
+    digest = map_digest(map_data)
+    cmap = _compiled.get(digest)
+    if cmap is None and cache_path is not None:
+        cmap = load_compiled(cache_path, digest)
+    if cmap is None:
+        cmap = compile_map(map_data)
+        if cache_path is not None:
+            save_compiled(cmap, cache_path)
+    _paths[key] = cmap
+    return cmap
\ No newline at end of file
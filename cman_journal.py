@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import io
+import os
+import socket
+import struct
+import time
+import cman_game_map as gm
+from cman_game import Game, Player, State
+
+# A journal is MAGIC and the digest of its map, followed by records, each starting with its kind byte and the room ID.
+# Moves are the bulk of a journal, so consecutive moves of a room are written as one record holding a byte per
+# move, player << 2 | direction. Records of different rooms may be reordered, those of one room never are.
+MAGIC = b'CMJ1'
+MOVES = 0x01  # Accepted moves: count, then the moves
+JOIN = 0x02  # Client seated: role, join flags, IPv4 address and port
+QUIT = 0x03  # Client left its seat: IPv4 address and port
+BOT = 0x04  # Bot seated: role
+START = 0x05  # Both roles taken, the game may start
+WINNER = 0x06  # Winner declared outside of a move, e.g. because a player quit: player
+CLOSE = 0x07  # Room torn down
+PROGRESS = 0x08  # Game state snapshot: coords, lives, state, then a length-prefixed collected bitset
+VARIABLE = (MOVES, PROGRESS)  # Records followed by as many bytes as the last 2 bytes of their header say
+MAX_RUN = 0xFFFF  # Moves in a single MOVES record
+
+RECORDS = {
+    MOVES: struct.Struct('!BHH'),
+    JOIN: struct.Struct('!BHbB4sH'),
+    QUIT: struct.Struct('!BH4sH'),
+    BOT: struct.Struct('!BHb'),
+    START: struct.Struct('!BH'),
+    WINNER: struct.Struct('!BHb'),
+    CLOSE: struct.Struct('!BH'),
+    PROGRESS: struct.Struct('!BH4HBBH'),
+}
+
+FLUSH_SIZE = 64 * 1024  # Buffered bytes that trigger a write
+FLUSH_INTERVAL = 0.2  # Seconds between periodic writes of the buffer
+
+class Journal:
+    """
+
+    Append-only journal writer. Records are collected in memory and written with a single
+    os.write() per flush, so the request handlers only ever append to a bytearray. Moves are
+    held per room until another record of the room or a flush needs them written.
+
+    """
+    def __init__(self, path, cmap, rooms=()):
+        """
+
+        Starts a new journal at path, replacing any previous one once the new one is complete.
+
+        Parameters:
+
+        path (str): path of the journal file
+
+        cmap (CompiledMap): the map every room is played on
+
+        rooms (iterable): (room ID, Game, [(client_addr, Player, join flags)], [bot Player]) of rooms
+        that already exist, written as a snapshot at the start of the journal
+
+        """
+        self.path = path
+        self.fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self.buffer = bytearray(MAGIC + cmap.digest)
+        self.runs = {}  # room_id -> moves not yet in the buffer
+        for room_id, game, clients, bots in rooms:
+            for client_addr, player, flags in clients:
+                self.join(room_id, player, flags, client_addr)
+            for player in bots:
+                self.bot(room_id, player)
+            self.progress(room_id, game)
+        self.flush()
+        os.replace(path + '.tmp', path)  # The previous journal stays valid until the snapshot is written
+
+    def _append(self, kind, room_id, *fields):
+        if room_id in self.runs:
+            self._end_run(room_id)
+        self.buffer += RECORDS[kind].pack(kind, room_id, *fields)
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+    def _end_run(self, room_id):
+        run = self.runs.pop(room_id)
+        self.buffer += RECORDS[MOVES].pack(MOVES, room_id, len(run))
+        self.buffer += run
+
+    def move(self, room_id, player, direction):
+        run = self.runs.get(room_id)
+        if run is None:
+            run = self.runs[room_id] = bytearray()
+        run.append(player << 2 | direction)
+        if len(run) == MAX_RUN:
+            self._end_run(room_id)
+
+    def join(self, room_id, player, flags, client_addr):
+        self._append(JOIN, room_id, player, flags, socket.inet_aton(client_addr[0]), client_addr[1])
+
+    def quit(self, room_id, client_addr):
+        self._append(QUIT, room_id, socket.inet_aton(client_addr[0]), client_addr[1])
+
+    def bot(self, room_id, player):
+        self._append(BOT, room_id, player)
+
+    def start(self, room_id):
+        self._append(START, room_id)
+
+    def winner(self, room_id, player):
+        self._append(WINNER, room_id, player)
+
+    def close(self, room_id):
+        self._append(CLOSE, room_id)
+
+    def progress(self, room_id, game):
+        (cr, cc), (sr, sc) = game.get_current_players_coords()
+        collected = game.get_collected_mask()
+        data = collected.to_bytes((collected.bit_length() + 7) // 8, 'little')
+        self._append(PROGRESS, room_id, cr, cc, sr, sc, game.lives, game.state, len(data))
+        self.buffer += data
+
+    def flush(self):
+        """Write the buffered records to the journal file."""
+        for room_id in list(self.runs):
+            self._end_run(room_id)
+        if self.buffer:
+            os.write(self.fd, self.buffer)
+            self.buffer.clear()
+
+class ReplayedRoom:
+    """State of one room rebuilt from a journal."""
+    __slots__ = ('room_id', 'game', 'clients', 'bots', 'moves')
+
+    def __init__(self, room_id, cmap):
+        self.room_id = room_id
+        self.game = Game(cmap)
+        self.clients = {}  # client_addr -> (Player, join flags)
+        self.bots = []  # Players taken by bots
+        self.moves = 0
+
+def replay(data, cmap, room_filter=None, on_close=None):
+    """
+
+    Rebuilds the rooms described by a journal by re-applying its records.
+
+    Parameters:
+
+    data (bytes): the journal contents, see Journal
+
+    cmap (CompiledMap): the map the journaled server played on
+
+    room_filter (int): only replay this room, None for all rooms
+
+    on_close (function): called with every ReplayedRoom whose CLOSE record is reached
+
+    Returns:
+
+    dict(int : ReplayedRoom): The rooms still open at the end of the journal
+
+    """
+    assert data[:len(MAGIC)] == MAGIC, "not a cman journal"
+    assert data[len(MAGIC):len(MAGIC) + len(cmap.digest)] == cmap.digest, "journal was written for another map"
+    rooms = {}
+    sizes = {kind: record.size for kind, record in RECORDS.items()}
+    restart = contextlib.redirect_stdout(io.StringIO())  # Game.restart_game prints
+    i = len(MAGIC) + len(cmap.digest)
+    end = len(data)
+    while i < end:
+        kind = data[i]
+        room_id = data[i + 1] << 8 | data[i + 2]
+        size = sizes[kind]
+        if i + size > end:
+            break  # Torn last record of a crashed writer
+        if kind in VARIABLE:
+            size += data[i + size - 2] << 8 | data[i + size - 1]
+            if i + size > end:
+                break
+        if room_filter is not None and room_id != room_filter:
+            i += size
+            continue
+        room = rooms.get(room_id)
+        if room is None:
+            with restart:
+                room = rooms[room_id] = ReplayedRoom(room_id, cmap)
+        if kind == MOVES:
+            header = RECORDS[MOVES].size
+            room.game.apply_moves(data[i + header:i + size])
+            room.moves += size - header
+        elif kind == JOIN:
+            _, _, player, flags, ip, port = RECORDS[JOIN].unpack_from(data, i)
+            room.clients[(socket.inet_ntoa(ip), port)] = (Player(player), flags)
+        elif kind == QUIT:
+            _, _, ip, port = RECORDS[QUIT].unpack_from(data, i)
+            room.clients.pop((socket.inet_ntoa(ip), port), None)
+        elif kind == BOT:
+            room.bots.append(Player(RECORDS[BOT].unpack_from(data, i)[2]))
+        elif kind == START:
+            room.game.state = State.START
+        elif kind == WINNER:
+            room.game.declare_winner(Player(RECORDS[WINNER].unpack_from(data, i)[2]))
+        elif kind == CLOSE:
+            del rooms[room_id]
+            if on_close is not None:
+                on_close(room)
+        elif kind == PROGRESS:
+            _, _, cr, cc, sr, sc, lives, state, _ = RECORDS[PROGRESS].unpack_from(data, i)
+            collected = int.from_bytes(data[i + RECORDS[PROGRESS].size:i + size], 'little')
+            room.game.load_progress([(cr, cc), (sr, sc)], lives, collected, State(state))
+        i += size
+    return rooms
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a cman_server move journal")
+    parser.add_argument('journal')
+    parser.add_argument('--map', default="map.txt", help="map the journaled server played on")
+    parser.add_argument('--room', type=int, help="only replay this room")
+    parser.add_argument('--closed', action='store_true', help="also print the final state of closed rooms")
+    args = parser.parse_args()
+
+    with open(args.journal, 'rb') as f:
+        data = f.read()
+    cmap = gm.load_map(args.map)
+
+    def describe(room, status):
+        game = room.game
+        lives, score = game.get_game_progress()
+        winner = game.get_winner()
+        print(f"room {room.room_id} ({status}): {room.moves} moves, state {game.state.name}, "
+              f"score {score}, lives {lives}, players at {game.get_current_players_coords()}"
+              + (f", winner {winner.name}" if winner != Player.NONE else ""))
+
+    moves = 0
+    def closed(room):
+        nonlocal moves
+        moves += room.moves
+        if args.closed:
+            describe(room, "closed")
+
+    start = time.perf_counter()
+    rooms = replay(data, cmap, args.room, closed)
+    elapsed = time.perf_counter() - start
+    for room in rooms.values():
+        moves += room.moves
+        describe(room, "open")
+    print(f"replayed {len(data)} bytes, {moves} moves in {elapsed:.3f}s ({moves / elapsed if elapsed else 0:,.0f} moves/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+from cman_game import Game, Player, Direction
+from cman_timers import Timers
+import cman_protocol as proto
+
+MOVE_TIMEOUT = 2.0  # Seconds after which an unacknowledged move counts as lost
+KEYS = {'w': Direction.UP, 'a': Direction.LEFT, 's': Direction.DOWN, 'd': Direction.RIGHT}
+
+class Stats:
+    """Counters and latency samples collected over a load test."""
+
+    def __init__(self):
+        self.sent = 0  # Datagrams sent
+        self.received = 0  # Datagrams received
+        self.moves = 0  # Move requests sent
+        self.answered = 0  # Moves whose effect reached the mover
+        self.lost = 0  # Moves not answered within MOVE_TIMEOUT
+        self.updates = 0  # State updates received by all clients
+        self.errors = 0  # 0xFF messages received
+        self.matches = 0  # Matches that ended with 0x8F
+        self.latencies = []  # Move-to-update latencies in seconds
+
+    def percentile(self, p):
+        if not self.latencies:
+            return float('nan')
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+class SimClient:
+    """A simulated cman, spirit or watcher client speaking the server's UDP protocol."""
+    __slots__ = ('test', 'sock', 'role', 'player', 'room_id', 'state', 'freeze', 'coords',
+                 'last_id', 'in_flight', 'script', 'script_pos', 'timer')
+
+    def __init__(self, test, role, room_id, script=None):
+        self.test = test
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.role = role  # Role byte of the join request
+        self.player = {1: Player.CMAN, 2: Player.SPIRIT}.get(role, Player.NONE)
+        self.room_id = room_id
+        self.state = proto.SequencedState()
+        self.freeze = 1
+        self.coords = None
+        self.last_id = 0
+        self.in_flight = {}  # input_id (or send order in legacy mode) -> send time
+        self.script = script
+        self.script_pos = 0
+        self.timer = None
+
+    def send(self, message):
+        self.sock.sendto(message, self.test.server)
+        self.test.stats.sent += 1
+
+    def join(self):
+        flags = 0 if self.test.legacy else proto.JOIN_SEQUENCED
+        self.send(bytes([0x00, self.role]) + self.room_id.to_bytes(2, 'big') + bytes([flags]))
+
+    def quit(self):
+        self.send(bytes([0x0F]))
+
+    def keepalive(self):
+        """Keep a watcher, which otherwise never sends, from being evicted as idle."""
+        self.timer = self.test.timers.call_later(proto.KEEPALIVE_INTERVAL, self.keepalive)
+        self.send(bytes([proto.KEEPALIVE]))
+
+    def next_direction(self):
+        """Pick the next scripted direction, or a random one that leads to a passable cell."""
+        if self.script:
+            direction = self.script[self.script_pos % len(self.script)]
+            self.script_pos += 1
+            return direction
+        game = self.test.game
+        height, width = game.board_dims
+        if self.coords is None or self.coords[0] >= height:
+            return None
+        cell = self.coords[0] * width + self.coords[1]
+        options = [d for d in Direction if game.neighbors[4 * cell + d] >= 0]
+        return random.choice(options) if options else None
+
+    def move(self):
+        """Send one move, if the server currently lets this player move."""
+        test = self.test
+        self.timer = test.timers.call_later(test.move_interval * random.uniform(0.5, 1.5), self.move)
+        if self.freeze:
+            return
+        direction = self.next_direction()
+        if direction is None:
+            return
+        now = time.perf_counter()
+        self.last_id = proto.next_input_id(self.last_id)
+        message = bytes([0x01, direction])
+        if not test.legacy:
+            message += self.last_id.to_bytes(2, 'big')
+        self.in_flight[self.last_id] = now
+        test.stats.moves += 1
+        self.send(message)
+
+    def answer_moves(self, ack, now):
+        """Record the latency of every in-flight move covered by ack."""
+        stats = self.test.stats
+        for input_id in [i for i in self.in_flight if not proto.seq_newer(i, ack)]:
+            stats.latencies.append(now - self.in_flight.pop(input_id))
+            stats.answered += 1
+
+    def expire_moves(self, now):
+        stats = self.test.stats
+        for input_id in [i for i, sent in self.in_flight.items() if now - sent > MOVE_TIMEOUT]:
+            del self.in_flight[input_id]
+            stats.lost += 1
+
+    def receive(self):
+        test = self.test
+        stats = test.stats
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            now = time.perf_counter()
+            stats.received += 1
+            opcode = data[0]
+            if opcode == proto.UPDATE or opcode == proto.WIDE_UPDATE:
+                stats.updates += 1
+                self.freeze, c_coords, s_coords, _, _ = proto.decode_update(data)
+                self.coords = (c_coords, s_coords)[self.player] if self.player != Player.NONE else None
+                if self.in_flight:
+                    # Without input IDs the first update after a move is taken as its answer
+                    self.answer_moves(self.last_id, now)
+            elif opcode == proto.KEYFRAME or opcode == proto.DELTA:
+                stats.updates += 1
+                if self.state.apply(data):
+                    self.freeze = self.state.freeze
+                    if self.player != Player.NONE:
+                        self.coords = (self.state.c_coords, self.state.s_coords)[self.player]
+                        self.answer_moves(self.state.ack, now)
+            elif opcode == 0x8F:
+                if self.player == Player.CMAN:
+                    stats.matches += 1
+                test.rejoin(self)
+            elif opcode == 0xFF:
+                stats.errors += 1
+
+class LoadTest:
+    """Drives simulated matches against a server and collects their statistics."""
+
+    def __init__(self, args):
+        self.server = (args.host, args.port)
+        self.legacy = args.legacy
+        self.move_interval = 1 / args.move_rate
+        self.watchers = args.watchers
+        self.game = Game(args.map)
+        self.timers = Timers()
+        self.selector = selectors.DefaultSelector()
+        self.stats = Stats()
+        self.clients = []
+        self.next_room = args.room_base
+        self.scripts = []
+        if args.script:
+            with open(args.script) as f:
+                self.scripts = [[KEYS[k] for k in line.strip() if k in KEYS] for line in f if line.strip()]
+        for _ in range(args.matches):
+            self.start_match()
+
+    def add_client(self, role, room_id, script=None):
+        client = SimClient(self, role, room_id, script)
+        self.selector.register(client.sock, selectors.EVENT_READ, client)
+        self.clients.append(client)
+        client.join()
+        if client.player != Player.NONE:
+            client.timer = self.timers.call_later(self.move_interval * random.random(), client.move)
+        else:
+            client.timer = self.timers.call_later(proto.KEEPALIVE_INTERVAL * random.random(), client.keepalive)
+        return client
+
+    def start_match(self):
+        room_id = self.next_room
+        self.next_room = (self.next_room + 1) & 0xFFFF
+        self.add_client(1, room_id, self.scripts[0] if self.scripts else None)
+        self.add_client(2, room_id, self.scripts[1 % len(self.scripts)] if self.scripts else None)
+        for _ in range(self.watchers):
+            self.add_client(0, room_id)
+
+    def rejoin(self, client):
+        """Move the clients of a finished match to a fresh room, the old one is held by the server for a while."""
+        if client.player != Player.CMAN:
+            return
+        room_id = client.room_id
+        self.next_room = (self.next_room + 1) & 0xFFFF
+        for other in self.clients:
+            if other.room_id == room_id:
+                other.room_id = self.next_room
+                other.state = proto.SequencedState()
+                other.freeze = 1
+                other.in_flight.clear()
+                other.join()
+
+    def run(self, duration):
+        deadline = time.monotonic() + duration
+        next_expiry = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            timeout = self.timers.timeout()
+            remaining = deadline - time.monotonic()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+            for key, _ in self.selector.select(max(0, timeout)):
+                key.data.receive()
+            self.timers.run_expired()
+            if time.monotonic() >= next_expiry:
+                now = time.perf_counter()
+                for client in self.clients:
+                    client.expire_moves(now)
+                next_expiry += 1
+        # Wait a little for in-flight answers, then count whatever is left as lost
+        end = time.monotonic() + 0.2
+        while time.monotonic() < end:
+            for key, _ in self.selector.select(0.05):
+                key.data.receive()
+        for client in self.clients:
+            self.stats.lost += len(client.in_flight)
+            client.in_flight.clear()
+            client.quit()
+            client.sock.close()
+
+    def report(self, duration):
+        stats = self.stats
+        total = stats.answered + stats.lost
+        loss = stats.lost / total if total else 0.0
+        print(f"clients: {len(self.clients)}, duration: {duration:.1f}s, matches finished: {stats.matches}")
+        print(f"datagrams sent: {stats.sent} ({stats.sent / duration:,.0f}/s), "
+              f"received: {stats.received} ({stats.received / duration:,.0f}/s)")
+        print(f"moves: {stats.moves}, answered: {stats.answered}, lost: {stats.lost} ({loss:.2%}), "
+              f"errors: {stats.errors}")
+        print(f"updates received: {stats.updates} ({stats.updates / duration:,.0f}/s)")
+        print("move-to-update latency ms: " + ", ".join(
+            f"p{p}={stats.percentile(p) * 1000:.2f}" for p in (50, 90, 99)) +
+            f", max={max(stats.latencies, default=float('nan')) * 1000:.2f}")
+        return loss
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP load generator and latency benchmark for cman_server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--map', default="map.txt")
+    parser.add_argument('--matches', type=int, default=10, help="concurrent matches, each in its own room")
+    parser.add_argument('--watchers', type=int, default=0, help="watchers per match")
+    parser.add_argument('--move-rate', type=float, default=10, help="moves per second per player")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run")
+    parser.add_argument('--room-base', type=int, default=1000, help="first room ID to use")
+    parser.add_argument('--script', help="file of wasd lines, the first drives cman and the second the spirit")
+    parser.add_argument('--legacy', action='store_true', help="use unsequenced 0x80 updates")
+    parser.add_argument('--spawn', action='store_true', help="start a local cman_server for the test")
+    parser.add_argument('--server-args', default="", help="extra arguments for the spawned server")
+    parser.add_argument('--max-p99-ms', type=float, help="fail if the p99 latency exceeds this")
+    parser.add_argument('--max-loss', type=float, help="fail if the lost move fraction exceeds this")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        here = os.path.dirname(os.path.abspath(__file__))
+        server = subprocess.Popen([sys.executable, os.path.join(here, 'cman_server.py'), str(args.port)] +
+                                  args.server_args.split(), cwd=here, stdout=subprocess.DEVNULL)
+        time.sleep(0.5)
+    try:
+        test = LoadTest(args)
+        test.run(args.duration)
+        loss = test.report(args.duration)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    failed = False
+    if args.max_p99_ms is not None and not test.stats.percentile(99) * 1000 <= args.max_p99_ms:
+        print(f"FAIL: p99 latency above {args.max_p99_ms} ms")
+        failed = True
+    if args.max_loss is not None and loss > args.max_loss:
+        print(f"FAIL: loss above {args.max_loss:.2%}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import functools
+import socket
+import sys
+import time
+
+# Histogram buckets are powers of two nanoseconds, from 2**MIN_EXP (256 ns) to 2**MAX_EXP (~1 s)
+MIN_EXP = 8
+MAX_EXP = 30
+
+class Histogram:
+    """Latency histogram with power of two buckets, observing costs one bit_length() and an increment."""
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (MAX_EXP - MIN_EXP + 2)  # The last bucket counts everything above 2**MAX_EXP
+        self.count = 0
+        self.sum = 0  # Nanoseconds
+
+    def observe(self, ns):
+        self.counts[min(max((ns - 1).bit_length() - MIN_EXP, 0), MAX_EXP - MIN_EXP + 1)] += 1
+        self.count += 1
+        self.sum += ns
+
+    def render(self, name, labels, out):
+        """Append the histogram in the Prometheus text format, with bounds in seconds."""
+        cumulative = 0
+        for exp, n in zip(range(MIN_EXP, MAX_EXP + 1), self.counts):
+            cumulative += n
+            out.append(f'{name}_bucket{{{labels}le="{2 ** exp / 1e9:g}"}} {cumulative}')
+        out.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = f'{{{labels.rstrip(",")}}}' if labels else ""
+        out.append(f'{name}_sum{labels} {self.sum / 1e9:.9f}')
+        out.append(f'{name}_count{labels} {self.count}')
+
+class Metrics:
+    """
+
+    Counters and histograms of one server process, rendered in the Prometheus text format.
+
+    Counting is done by the caller checking that metrics are enabled, timing by wrapping
+    functions with timed(), so a process without metrics pays nothing for either.
+
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.received = [0] * 256  # Datagrams handled per opcode
+        self.received_bytes = 0
+        self.sent = [0] * 256  # Datagrams sent per opcode
+        self.sent_bytes = 0
+        self.limited = [0] * 256  # Datagrams over the sender's rate limit per opcode
+        self.handlers = {}  # Function name -> Histogram of its run time
+        self.loop = True  # Whether the server loop counts its wake-ups, the asyncio engine cannot
+        self.wakeups = 0  # Returns from select()
+        self.iteration = Histogram()  # Time spent handling each wake-up
+        self.gauges = {}  # name -> (help text, function returning the value)
+
+    def count_received(self, data):
+        self.received[data[0]] += 1
+        self.received_bytes += len(data)
+
+    def count_limited(self, opcode):
+        self.limited[opcode] += 1
+
+    def count_sent(self, message):
+        self.sent[message[0]] += 1
+        self.sent_bytes += len(message)
+
+    def gauge(self, name, help_text, value):
+        """Register a gauge whose value is read from value() whenever the metrics are rendered."""
+        self.gauges[name] = (help_text, value)
+
+    def timed(self, func):
+        """Returns a wrapper of func that records its run time under func's name."""
+        histogram = self.handlers.setdefault(func.__name__, Histogram())
+        clock = time.perf_counter_ns
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(clock() - start)
+        return wrapper
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        out = []
+
+        def header(name, kind, help_text):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        header("cman_uptime_seconds", "gauge", "Seconds since metrics were enabled")
+        out.append(f"cman_uptime_seconds {time.time() - self.started:.3f}")
+        for direction, counts, total in (("received", self.received, self.received_bytes),
+                                         ("sent", self.sent, self.sent_bytes)):
+            header(f"cman_datagrams_{direction}_total", "counter", f"Datagrams {direction}, by opcode")
+            out.extend(f'cman_datagrams_{direction}_total{{opcode="0x{opcode:02X}"}} {n}'
+                       for opcode, n in enumerate(counts) if n)
+            header(f"cman_bytes_{direction}_total", "counter", f"Payload bytes {direction}")
+            out.append(f"cman_bytes_{direction}_total {total}")
+        header("cman_datagrams_limited_total", "counter", "Datagrams over the sender's rate limit, by opcode")
+        out.extend(f'cman_datagrams_limited_total{{opcode="0x{opcode:02X}"}} {n}'
+                   for opcode, n in enumerate(self.limited) if n)
+        header("cman_handler_seconds", "histogram", "Run time of request handlers and broadcasts")
+        for name, histogram in self.handlers.items():
+            histogram.render("cman_handler_seconds", f'handler="{name}",', out)
+        if self.loop:
+            header("cman_loop_wakeups_total", "counter", "Server loop wake-ups")
+            out.append(f"cman_loop_wakeups_total {self.wakeups}")
+            header("cman_loop_iteration_seconds", "histogram", "Time spent handling each server loop wake-up")
+            self.iteration.render("cman_loop_iteration_seconds", "", out)
+        for name, (help_text, value) in self.gauges.items():
+            header(name, "gauge", help_text)
+            out.append(f"{name} {value()}")
+        return "\n".join(out) + "\n"
+
+def scrape(path, timeout=2.0):
+    """Returns the metrics text served on the UNIX socket at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+    return b"".join(chunks).decode()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <metrics socket>")
+        sys.exit(1)
+    sys.stdout.write(scrape(sys.argv[1]))
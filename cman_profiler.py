@@ -0,0 +1,124 @@
+import os
+import signal
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005  # Seconds of CPU time between stack samples
+ALLOC_FRAMES = 8  # Frames kept per traced allocation
+ALLOC_TOP = 25  # Allocation sites listed in a report
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Profiler:
+    """
+
+    On-demand profiler of a server process, started and stopped while the process runs.
+
+    CPU time is profiled by sampling: an ITIMER_PROF timer interrupts the process every
+    SAMPLE_INTERVAL seconds of CPU time and the interrupted stack is counted. Stopping writes
+    the counts as collapsed stacks, one "outer;...;inner count" line per stack, the input of
+    flamegraph.pl, speedscope and similar tools. Allocations are traced with tracemalloc, and
+    stopping writes the allocation sites holding the most memory.
+
+    Neither installs anything until started, so an idle Profiler costs nothing.
+
+    """
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix  # Start of the file names, tells processes apart
+        self.samples = None  # Counter of stacks as tuples of code objects, outermost first, None while stopped
+        self.sampling_since = None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+
+    def start_sampling(self, interval=SAMPLE_INTERVAL):
+        self.samples = Counter()
+        self.sampling_since = time.monotonic()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def stop_sampling(self):
+        """Stop sampling and write the collapsed stacks, returns the path written."""
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        samples, self.samples = self.samples, None
+        path = self.path(".folded")
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{';'.join(frame_name(code) for code in stack)} {count}\n")
+        print(f"Wrote {sum(samples.values())} samples of {time.monotonic() - self.sampling_since:.1f}s to {path}")
+        return path
+
+    def toggle_sampling(self, *_):
+        """Signal handler starting or stopping the stack sampler."""
+        if self.samples is None:
+            self.start_sampling()
+            print("Stack sampling started")
+        else:
+            self.stop_sampling()
+
+    def start_tracing(self, frames=ALLOC_FRAMES):
+        tracemalloc.start(frames)
+
+    def stop_tracing(self, top=ALLOC_TOP):
+        """Stop tracing allocations and write the top allocation sites, returns the path written."""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),  # The stacks of a concurrent stack sampling
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = snapshot.statistics('traceback')
+        path = self.path(".alloc.txt")
+        with open(path, 'w') as f:
+            f.write(f"traced {traced} bytes, peak {peak} bytes, {len(stats)} allocation sites\n")
+            for i, stat in enumerate(stats[:top], 1):
+                f.write(f"\n#{i}: {stat.size} bytes in {stat.count} blocks\n")
+                for line in stat.traceback.format(most_recent_first=True):
+                    f.write(line + "\n")
+        print(f"Wrote the top {min(top, len(stats))} allocation sites to {path}")
+        return path
+
+    def toggle_tracing(self, *_):
+        """Signal handler starting or stopping allocation tracing."""
+        if not tracemalloc.is_tracing():
+            self.start_tracing()
+            print("Allocation tracing started")
+        else:
+            self.stop_tracing()
+
+    def install(self):
+        """Toggle stack sampling on SIGUSR1 and allocation tracing on SIGUSR2."""
+        signal.signal(signal.SIGUSR1, self.toggle_sampling)
+        signal.signal(signal.SIGUSR2, self.toggle_tracing)
+
+def self_time(path):
+    """Returns a Counter of the samples each frame was on top of the stack in, read from a collapsed-stack file."""
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            counts[stack.rpartition(';')[2]] += int(count)
+    return counts
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <collapsed stacks file>")
+        sys.exit(1)
+    counts = self_time(sys.argv[1])
+    total = sum(counts.values())
+    for frame, count in counts.most_common(ALLOC_TOP):
+        print(f"{count:8} {count / total:7.1%}  {frame}")
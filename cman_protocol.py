@@ -0,0 +1,257 @@
+import socket
+import struct
+
+# Flags that may follow the room ID in a join request
+JOIN_SEQUENCED = 0x01  # Client wants sequenced keyframe/delta updates instead of 0x80
+JOIN_RELAY = 0x02  # Joining watcher is a relay subscribing to the room, it is never redirected
+JOIN_REDIRECT = 0x04  # Client follows 0x8D redirects of watcher joins to a relay
+
+KEEPALIVE = 0x02  # Client to server: still here, sent by otherwise quiet clients
+KEEPALIVE_INTERVAL = 10  # Seconds a client may stay quiet before it sends a keepalive
+
+UPDATE = 0x80  # Full, unsequenced game state
+KEYFRAME = 0x81  # Full game state with a sequence number
+DELTA = 0x82  # Changes since the previous sequence number
+WIDE_UPDATE = 0x84  # Full, unsequenced game state of a map too big for 0x80
+REDIRECT = 0x8D  # Join again at another address: IPv4 address and port
+
+# Freeze byte bit of a keyframe that starts a new sequence, accepted whatever sequence number the recipient saw
+# last. A server that recovered a room from its journal no longer knows the room's sequence numbers.
+KEYFRAME_RESET = 0x80
+
+# Field bits of a delta message, in the order the fields are encoded
+DELTA_CMAN = 0x01  # Cman coordinates changed (2 bytes)
+DELTA_SPIRIT = 0x02  # Spirit coordinates changed (2 bytes)
+DELTA_ATTEMPTS = 0x04  # Caught attempts changed (1 byte)
+DELTA_COLLECTED = 0x08  # Points were collected (2 byte count, then 2 bytes per point index)
+
+# Coordinates are 16 bit except in 0x80, which has one byte per coordinate and 0xFF for absent players
+NO_COORDS = (0xFFFF, 0xFFFF)  # Coordinates of an absent player
+LEGACY_MAX_DIM = 0xFF  # Rows and columns of maps that 0x80 can describe, coordinate 0xFF is never a cell
+LEGACY_MAX_POINTS = 40  # Points that fit the 5 byte collected mask of 0x80
+
+# Collected masks of keyframes and 0x84 messages are length-prefixed little-endian bitsets:
+# a 2 byte length, then as many bytes as the highest collected point needs
+UPDATE_HEADER = struct.Struct('!BB4BB')  # opcode, freeze, cman and spirit coords, attempts
+WIDE_UPDATE_HEADER = struct.Struct('!BB4HB')  # opcode, freeze, cman and spirit coords, attempts
+KEYFRAME_HEADER = struct.Struct('!BHBH4HB')  # opcode, seq, freeze, ack, cman and spirit coords, attempts
+DELTA_HEADER = struct.Struct('!BHBHB')  # opcode, seq, freeze, ack, field bits
+ACK = struct.Struct('!H')
+COORDS = struct.Struct('!2H')
+COUNT = struct.Struct('!H')  # Length of a bitset or number of point indices
+REDIRECT_MESSAGE = struct.Struct('!B4sH')
+ACK_OFFSET = 4  # Offset of the ack in keyframe and delta messages, right after the freeze byte
+COLLECTED_BYTES = 5  # Bytes of the collected points mask in 0x80 messages
+
+def fits_update(board_dims, n_points):
+    """Returns whether the states of a map with these dimensions and point count fit 0x80 messages."""
+    return board_dims[0] <= LEGACY_MAX_DIM and board_dims[1] <= LEGACY_MAX_DIM and n_points <= LEGACY_MAX_POINTS
+
+def encode_bitset(mask):
+    """Returns a collected mask as a length-prefixed bitset."""
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+    return COUNT.pack(len(data)) + data
+
+def decode_bitset(data, offset):
+    """Returns the mask of the length-prefixed bitset at offset, and the offset following it."""
+    (length,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    return int.from_bytes(data[offset:offset + length], 'little'), offset + length
+
+def encode_redirect(addr):
+    """Returns a 0x8D message sending a client to the IPv4 (host, port) addr."""
+    return REDIRECT_MESSAGE.pack(REDIRECT, socket.inet_aton(addr[0]), addr[1])
+
+def decode_redirect(data):
+    """Returns the (host, port) a 0x8D message redirects to."""
+    _, ip, port = REDIRECT_MESSAGE.unpack_from(data)
+    return socket.inet_ntoa(ip), port
+
+def seq_newer(seq, than):
+    """Returns whether the 16 bit sequence number seq comes after than, allowing for wrap-around."""
+    return 0 < ((seq - than) & 0xFFFF) < 0x8000
+
+def next_input_id(input_id):
+    """Returns the input ID following input_id, IDs run from 1 to 0xFFFF and 0 means no input."""
+    return input_id % 0xFFFF + 1
+
+def with_ack(message, ack):
+    """Returns a copy of a keyframe or delta message acknowledging the recipient's input ack."""
+    return message[:ACK_OFFSET] + ACK.pack(ack) + message[ACK_OFFSET + ACK.size:]
+
+def encode_keyframe(seq, freeze, state, ack=0):
+    """
+
+    Encodes a full game state with its sequence number.
+
+    Parameters:
+
+    seq (int): 16 bit sequence number of the state
+
+    freeze (int): 0 if the recipient may move, 1 otherwise, with KEYFRAME_RESET set to start a new sequence
+
+    state (tuple): (cman coords, spirit coords, attempts, collected mask)
+
+    ack (int): ID of the last move input of the recipient the server processed, 0 if none
+
+    """
+    c_coords, s_coords, attempts, collected = state
+    return KEYFRAME_HEADER.pack(KEYFRAME, seq, freeze, ack, c_coords[0], c_coords[1], s_coords[0], s_coords[1],
+                                attempts) + encode_bitset(collected)
+
+def encode_delta(seq, freeze, previous, state, ack=0):
+    """
+
+    Encodes the changes between two consecutive game states.
+
+    Parameters:
+
+    seq (int): 16 bit sequence number of state, previous has number seq - 1
+
+    freeze (int): 0 if the recipient may move, 1 otherwise
+
+    previous (tuple): The state the recipient is expected to hold, see encode_keyframe()
+
+    state (tuple): The new state, its collected mask must be a superset of the previous one
+
+    ack (int): ID of the last move input of the recipient the server processed, 0 if none
+
+    """
+    fields = 0
+    body = bytearray()
+    if state[0] != previous[0]:
+        fields |= DELTA_CMAN
+        body += COORDS.pack(*state[0])
+    if state[1] != previous[1]:
+        fields |= DELTA_SPIRIT
+        body += COORDS.pack(*state[1])
+    if state[2] != previous[2]:
+        fields |= DELTA_ATTEMPTS
+        body.append(state[2])
+    new_points = state[3] & ~previous[3]
+    if new_points:
+        # Usually a single point, so one index per point beats a bitset
+        fields |= DELTA_COLLECTED
+        indices = []
+        while new_points:
+            low = new_points & -new_points
+            indices.append(low.bit_length() - 1)
+            new_points ^= low
+        body += struct.pack(f'!H{len(indices)}H', len(indices), *indices)
+    return DELTA_HEADER.pack(DELTA, seq, freeze, ack, fields) + body
+
+def encode_update(freeze, state):
+    """
+
+    Encodes a full 0x80 game state message.
+
+    Parameters:
+
+    freeze (int): 0 if the recipient may move, 1 otherwise
+
+    state (tuple): (cman coords, spirit coords, attempts, collected mask) of a map that fits 0x80
+
+    """
+    c_coords, s_coords, attempts, collected = state
+    # Absent players are at NO_COORDS, which 0x80 sends as 0xFF
+    return UPDATE_HEADER.pack(UPDATE, freeze, min(c_coords[0], 0xFF), min(c_coords[1], 0xFF),
+                              min(s_coords[0], 0xFF), min(s_coords[1], 0xFF),
+                              attempts) + collected.to_bytes(COLLECTED_BYTES, 'little')
+
+def encode_wide_update(freeze, state):
+    """
+
+    Encodes a full 0x84 game state message, the 0x80 equivalent for maps that do not fit it.
+
+    Parameters:
+
+    freeze (int): 0 if the recipient may move, 1 otherwise
+
+    state (tuple): (cman coords, spirit coords, attempts, collected mask)
+
+    """
+    c_coords, s_coords, attempts, collected = state
+    return WIDE_UPDATE_HEADER.pack(WIDE_UPDATE, freeze, c_coords[0], c_coords[1], s_coords[0], s_coords[1],
+                                   attempts) + encode_bitset(collected)
+
+def decode_update(data):
+    """
+
+    Decodes a full 0x80 or 0x84 game state message.
+
+    Returns:
+
+    tuple: (freeze, cman coords, spirit coords, attempts, collected mask), absent players at NO_COORDS
+
+    """
+    if data[0] == WIDE_UPDATE:
+        _, freeze, cr, cc, sr, sc, attempts = WIDE_UPDATE_HEADER.unpack_from(data)
+        return freeze, (cr, cc), (sr, sc), attempts, decode_bitset(data, WIDE_UPDATE_HEADER.size)[0]
+    # Row 0xFF is never a cell of a map that fits 0x80, so it alone marks an absent player
+    return (data[1], (data[2], data[3]) if data[2] != 0xFF else NO_COORDS,
+            (data[4], data[5]) if data[4] != 0xFF else NO_COORDS, data[6],
+            int.from_bytes(data[UPDATE_HEADER.size:UPDATE_HEADER.size + COLLECTED_BYTES], 'little'))
+
+class SequencedState:
+    """
+
+    Client side view of a sequenced game state.
+
+    Keyframes are applied whenever they are newer than the current state, deltas only
+    when they directly follow it, so stale, duplicated or reordered datagrams never move
+    the state backwards. After a lost delta the state waits for the next keyframe.
+
+    """
+    def __init__(self):
+        self.seq = None  # None until the first keyframe arrived
+        self.freeze = 1
+        self.ack = 0  # ID of our last move input the server processed
+        self.c_coords = NO_COORDS
+        self.s_coords = NO_COORDS
+        self.attempts = 0
+        self.collected = 0
+
+    def apply(self, data):
+        """
+
+        Applies a keyframe or delta message.
+
+        Returns:
+
+        bool: Whether the state advanced
+
+        """
+        opcode = data[0]
+        if opcode == KEYFRAME:
+            _, seq, freeze, ack, cr, cc, sr, sc, attempts = KEYFRAME_HEADER.unpack_from(data)
+            if self.seq is not None and not freeze & KEYFRAME_RESET and not seq_newer(seq, self.seq):
+                return False
+            freeze &= ~KEYFRAME_RESET
+            self.c_coords = (cr, cc)
+            self.s_coords = (sr, sc)
+            self.attempts = attempts
+            self.collected = decode_bitset(data, KEYFRAME_HEADER.size)[0]
+        elif opcode == DELTA:
+            _, seq, freeze, ack, fields = DELTA_HEADER.unpack_from(data)
+            if self.seq is None or seq != (self.seq + 1) & 0xFFFF:
+                return False
+            i = DELTA_HEADER.size
+            if fields & DELTA_CMAN:
+                self.c_coords = COORDS.unpack_from(data, i)
+                i += COORDS.size
+            if fields & DELTA_SPIRIT:
+                self.s_coords = COORDS.unpack_from(data, i)
+                i += COORDS.size
+            if fields & DELTA_ATTEMPTS:
+                self.attempts = data[i]
+                i += 1
+            if fields & DELTA_COLLECTED:
+                (count,) = COUNT.unpack_from(data, i)
+                for index in struct.unpack_from(f'!{count}H', data, i + COUNT.size):
+                    self.collected |= 1 << index
+        else:
+            return False
+        self.seq = seq
+        self.freeze = freeze
+        self.ack = ack
+        return True
@@ -0,0 +1,231 @@
+import argparse
+import selectors
+import socket
+import time
+import cman_game_map as gm
+import cman_protocol as proto
+from cman_timers import Timers
+
+RELAY_PORT = 1338
+SUBSCRIBE_RETRY = 1.0  # Seconds between join requests to the upstream until it answers
+IDLE_TIMEOUT = 60  # Seconds after which a watcher that sent nothing is dropped, if it sends keepalives at all
+
+class Subscription:
+    """
+
+    One room relayed from upstream: the socket the room is watched through, its latest
+    state and the watchers it is fanned out to.
+
+    Sequenced watchers get the upstream keyframes and deltas exactly as received, so their
+    sequence numbers match the upstream's. Legacy watchers get a 0x80 (or 0x84) message
+    encoded once per state change for all of them.
+
+    """
+    __slots__ = ('relay', 'room_id', 'sock', 'state', 'sequenced', 'legacy', 'retry', 'keepalive')
+
+    def __init__(self, relay, room_id):
+        self.relay = relay
+        self.room_id = room_id
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # The upstream tells subscriptions apart by address
+        self.sock.setblocking(False)
+        self.state = proto.SequencedState()
+        self.sequenced = set()  # Watcher addresses
+        self.legacy = set()
+        self.retry = None
+        self.subscribe()
+        self.keepalive = self.relay.timers.call_later(proto.KEEPALIVE_INTERVAL, self.send_keepalive)
+
+    def subscribe(self):
+        """Join the room upstream as a relay, repeated until the upstream answers."""
+        flags = proto.JOIN_SEQUENCED | proto.JOIN_RELAY
+        self.sock.sendto(bytes([0x00, 0x00]) + self.room_id.to_bytes(2, 'big') + bytes([flags]), self.relay.upstream)
+        self.retry = self.relay.timers.call_later(SUBSCRIBE_RETRY, self.subscribe)
+
+    def send_keepalive(self):
+        """Keep the upstream from evicting the subscription, it otherwise only receives."""
+        self.sock.sendto(bytes([proto.KEEPALIVE]), self.relay.upstream)
+        self.keepalive = self.relay.timers.call_later(proto.KEEPALIVE_INTERVAL, self.send_keepalive)
+
+    def unsubscribe(self):
+        self.retry.cancel()
+        self.keepalive.cancel()
+        self.sock.sendto(bytes([0x0F]), self.relay.upstream)
+        self.sock.close()
+
+    def get_state(self):
+        """Returns the latest state as (cman coords, spirit coords, attempts, collected mask)."""
+        state = self.state
+        return state.c_coords, state.s_coords, state.attempts, state.collected
+
+    def add(self, client_addr, flags):
+        """Add a watcher and send it the latest state, if there is one yet."""
+        if flags & proto.JOIN_SEQUENCED:
+            self.legacy.discard(client_addr)
+            self.sequenced.add(client_addr)
+            if self.state.seq is not None:
+                self.relay.send(client_addr, proto.encode_keyframe(self.state.seq, 1, self.get_state()))
+        else:
+            self.sequenced.discard(client_addr)
+            self.legacy.add(client_addr)
+            if self.state.seq is not None:
+                self.relay.send(client_addr, self.relay.encode_update(1, self.get_state()))
+
+    def remove(self, client_addr):
+        self.sequenced.discard(client_addr)
+        self.legacy.discard(client_addr)
+
+    def receive(self):
+        relay = self.relay
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                continue  # Upstream not up yet, the subscription is retried
+            if not data:
+                continue
+            self.retry.cancel()
+            opcode = data[0]
+            if opcode == proto.KEYFRAME or opcode == proto.DELTA:
+                if not self.state.apply(data):
+                    continue  # Our watchers would drop it as well
+                for client_addr in self.sequenced:
+                    relay.send(client_addr, data)
+                if self.legacy:
+                    update = relay.encode_update(1, self.get_state())
+                    for client_addr in self.legacy:
+                        relay.send(client_addr, update)
+            elif opcode == 0x8F:  # Game end, the match is over for every watcher
+                for client_addr in self.sequenced | self.legacy:
+                    relay.send(client_addr, data)
+                relay.close(self)
+                return
+
+class Relay:
+    """
+
+    Spectator relay. Watchers join it exactly as they would join the server, and the relay
+    watches each of their rooms upstream once, so the upstream sends an update to one relay
+    instead of to all of its watchers. The upstream is the server or another relay, relays
+    can therefore be chained into a tree, and a relay may itself redirect its watchers to
+    child relays.
+
+    """
+    def __init__(self, port, upstream, children, cmap):
+        self.upstream = upstream
+        self.children = children  # (IPv4 address, port) of relays watchers are redirected to
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', port))
+        self.sock.setblocking(False)
+        self.timers = Timers()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self)
+        self.subscriptions = {}  # room_id -> Subscription
+        self.watching = {}  # client_addr -> Subscription
+        self.last_seen = {}  # client_addr -> time of the last datagram of a watcher that sends keepalives
+        self.timers.call_later(IDLE_TIMEOUT, self.drop_idle)
+        self.encode_update = proto.encode_update if proto.fits_update(cmap.board_dims, len(cmap.point_index)) \
+            else proto.encode_wide_update
+
+    def send(self, client_addr, message):
+        self.sock.sendto(message, client_addr)
+
+    def close(self, subscription):
+        del self.subscriptions[subscription.room_id]
+        for client_addr in subscription.sequenced | subscription.legacy:
+            del self.watching[client_addr]
+            self.last_seen.pop(client_addr, None)
+        self.selector.unregister(subscription.sock)
+        subscription.unsubscribe()
+        print(f"Stopped relaying room {subscription.room_id}")
+
+    def handle_join(self, client_addr, role, room_id, flags):
+        if flags & proto.JOIN_REDIRECT and not flags & proto.JOIN_RELAY:
+            if role != 0:
+                self.send(client_addr, proto.encode_redirect(self.upstream))  # Players are seated by the server
+                return
+            if self.children:
+                self.send(client_addr, proto.encode_redirect(self.children[hash(client_addr) % len(self.children)]))
+                return
+        if role != 0:
+            self.send(client_addr, bytes([0xFF, 0x05]))  # Invalid role, a relay only takes watchers
+            return
+        current = self.watching.get(client_addr)
+        if current is not None and current.room_id != room_id:
+            self.handle_quit(client_addr)
+        subscription = self.subscriptions.get(room_id)
+        if subscription is None:
+            subscription = self.subscriptions[room_id] = Subscription(self, room_id)
+            self.selector.register(subscription.sock, selectors.EVENT_READ, subscription)
+            print(f"Relaying room {room_id}")
+        subscription.add(client_addr, flags)
+        self.watching[client_addr] = subscription
+        if flags & proto.JOIN_SEQUENCED:
+            self.last_seen[client_addr] = time.monotonic()  # Sequenced clients send keepalives, legacy ones never do
+
+    def handle_quit(self, client_addr):
+        subscription = self.watching.pop(client_addr, None)
+        self.last_seen.pop(client_addr, None)
+        if subscription is not None:
+            subscription.remove(client_addr)
+            if not subscription.sequenced and not subscription.legacy:
+                self.close(subscription)
+
+    def receive(self):
+        while True:
+            try:
+                data, client_addr = self.sock.recvfrom(65536)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                continue
+            if not data:
+                continue
+            opcode = data[0]
+            if client_addr in self.last_seen or opcode == proto.KEEPALIVE and client_addr in self.watching:
+                self.last_seen[client_addr] = time.monotonic()
+            if opcode == 0x00 and len(data) >= 2:
+                room_id = int.from_bytes(data[2:4], 'big') if len(data) >= 4 else 0
+                self.handle_join(client_addr, data[1], room_id, data[4] if len(data) >= 5 else 0)
+            elif opcode == 0x0F:
+                self.handle_quit(client_addr)
+            # Watchers cannot move, move requests are dropped
+
+    def drop_idle(self):
+        """Drop the watchers that stopped sending keepalives without quitting, checked every IDLE_TIMEOUT seconds."""
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        for client_addr in [addr for addr, seen in self.last_seen.items() if seen < deadline]:
+            print(f"Watcher {client_addr} idle, dropped")
+            self.handle_quit(client_addr)
+        self.timers.call_later(IDLE_TIMEOUT, self.drop_idle)
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self.selector.select(self.timers.timeout()):
+                key.data.receive()
+            self.timers.run_expired()
+
+def parse_addr(text):
+    """Returns the (IPv4 address, port) of a HOST:PORT argument."""
+    host, _, port = text.rpartition(':')
+    return socket.gethostbyname(host), int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectator relay re-broadcasting C-Man matches to watchers")
+    parser.add_argument('upstream', type=parse_addr, metavar='HOST:PORT', help="server or parent relay")
+    parser.add_argument('port', nargs='?', type=int, default=RELAY_PORT)
+    parser.add_argument('--relay', type=parse_addr, metavar='HOST:PORT', action='append', default=[],
+                        help="redirect watchers to this child relay, may be given several times")
+    parser.add_argument('--map', default="map.txt", help="map the server plays, decides 0x80 or 0x84 updates")
+    args = parser.parse_args()
+
+    relay = Relay(args.port, args.upstream, args.relay, gm.load_map(args.map))
+    print(f"Relay listening on port {args.port}, upstream {args.upstream[0]}:{args.upstream[1]}")
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
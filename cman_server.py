@@ -1,208 +1,1094 @@
 import socket
 import select
-import time
 import sys
+import os
+import signal
+import struct
+import argparse
+import asyncio
+import time
+from collections import deque
 from cman_game import Game, Player, Direction, State  # Assume game logic is in a separate file
+from cman_timers import Timers, TimerWheel
+import cman_protocol as proto
+import cman_bot
+import cman_game_map as gm
+import cman_metrics
+import cman_journal
+import cman_profiler
 
 # Constants
 SERVER_PORT = 1337
 SERVER_IP = '0.0.0.0'
-TIMEOUT = 0.01  # Timeout for select, adjust as needed
+GAME_END_DELAY = 10  # Seconds a finished match is held before its room is torn down
+ENGINE = 'select'  # Server loop implementation, 'select' or 'asyncio'
+TICK_RATE = 0  # Simulation ticks per second, 0 applies every move as soon as it arrives
+MOVE_QUEUE_DEPTH = 4  # Moves a player may have queued for upcoming ticks
+KEYFRAME_INTERVAL = 32  # Every this many sequenced updates is a full keyframe
 MAX_ATTEMPTS = 3
 WIN_SCORE = 32
 
-# Game instance
-game = None
+# Map shared by every room hosted by this process
+MAP_PATH = "map.txt"
+MAP_CACHE = None  # Optional path of the compiled map, mmapped instead of parsing MAP_PATH at startup
+DEFAULT_ROOM = 0  # Room used by clients that do not send a room ID
+MAX_POOLED_GAMES = 64  # Finished Game instances kept around for reuse
+
+# Server-side bots take the roles no human took within BOT_FILL_DELAY seconds of a room's first join
+BOT_ROLES = ()  # Roles bots may fill, e.g. (Player.SPIRIT,)
+BOT_FILL_DELAY = 5
+BOT_MOVE_RATE = 4  # Moves per second of each bot
+BOT_HOST = 'bot'  # Host part of the pseudo address a bot is seated under, nothing is ever sent to it
 
-server_socket = None  # Server socket for communication
-# List of clients and their roles
-clients = {}
+# Spectator relays (cman_relay.py). Watchers that accept redirects are sent to the relay serving their room,
+# so the server sends each update to one relay instead of to every watcher.
+RELAYS = []  # (IPv4 address, port) of the relays, a room is served by RELAYS[room_id % len(RELAYS)]
+
+server_socket = None  # Server socket for communication (or the asyncio transport, which has the same sendto())
+event_loop = None  # Running asyncio loop when ENGINE is 'asyncio'
+timers = Timers()  # Scheduled callbacks of the select engine
+ticking_rooms = set()  # Rooms with moves queued for the next tick
+tick_timer = None  # Pending tick, None while no room has queued moves
+rooms = {}  # room_id -> Room
+sessions = {}  # client_addr -> Session of the client, in the room it is seated in
+game_pool = []  # Restarted Game instances waiting to be handed to a new room
 roles = {0:Player.NONE, 1:Player.CMAN, 2:Player.SPIRIT}  # Keep track of CMAN and SPIRIT
+DIRECTIONS = tuple(Direction)  # Direction byte -> Direction, without building an enum per move
 
-spectators = []
+# Clients that vanish without quitting are evicted once they sent nothing for IDLE_TIMEOUT seconds,
+# players as if they had quit. Our clients send proto.KEEPALIVE while they have nothing else to send.
+# Clients of the original protocol never do, so only sequenced clients, which all send keepalives, and
+# clients that sent one are ever evicted.
+IDLE_TIMEOUT = 60  # 0 keeps idle clients forever
+IDLE_RESOLUTION = 1.0  # Seconds between sweeps of the idle timer wheel
+idle_timers = TimerWheel(IDLE_RESOLUTION)  # Idle timeouts of the sessions, one per session
 
-def get_game_update(addr):
-    """Get the game update message for a client."""
+# Token buckets limit how fast one address may send each opcode, so a flood of moves or joins from a single
+# peer cannot turn into a broadcast per datagram and starve every other room. Datagrams over the limit are
+# dropped, or with QUEUE_EXCESS_MOVES, moves over the limit wait in the tick queue of their player.
+JOIN_RATE_LIMIT = 2  # Joins per second of an address, 0 disables the limit
+JOIN_BURST = 5
+MOVE_RATE_LIMIT = 60  # Moves per second of an address, 0 disables the limit
+MOVE_BURST = 30
+RATE_LIMITS = {0x00: (JOIN_RATE_LIMIT, JOIN_BURST), 0x01: (MOVE_RATE_LIMIT, MOVE_BURST)}  # opcode -> (rate, burst)
+QUEUE_EXCESS_MOVES = False
+RATE_SWEEP_INTERVAL = 10  # Seconds between sweeps of the buckets that are full again
+buckets = {}  # (client_addr, opcode) -> Bucket
+
+# The select engine handles every datagram waiting on the server socket per wake-up. They are received
+# into one reusable buffer, and the broadcasts they cause are deferred to the end of the batch, so a room
+# that changed several times within a batch is broadcast once.
+RECV_BATCH = 256  # Datagrams handled per wake-up at most, bounds how long timers wait under load
+RECV_BUFFER_SIZE = 2048
+recv_buffer = bytearray(RECV_BUFFER_SIZE)
+recv_view = memoryview(recv_buffer)
+batching = False  # Whether a receive batch is being handled
+dirty_rooms = set()  # Rooms whose broadcast is deferred to the end of the current batch
+
+# Metrics are served in the Prometheus text format to every connection on a UNIX socket,
+# workers append their index to the path
+METRICS_SOCKET = None  # Socket path, None disables metrics
+metrics = None  # cman_metrics.Metrics of this process while enabled
+metrics_listener = None
+
+# SIGUSR1 toggles stack sampling of a running server and SIGUSR2 allocation tracing, see cman_profiler.Profiler
+PROFILE_DIR = '.'  # Directory the profiles are written to
+TIMED_FUNCTIONS = ('handle_join_request', 'handle_move_request', 'handle_exit_request', 'broadcast_update',
+                   'run_tick', 'run_bots')
+
+# Journal of every accepted move, join and quit, workers append their index to the path.
+# With RECOVER set, the live rooms of a previous run are rebuilt from it at startup.
+JOURNAL_PATH = None  # None disables the journal
+RECOVER = False
+journal = None  # cman_journal.Journal of this process while enabled
+
+# Multi-process mode: every worker binds SERVER_PORT with SO_REUSEPORT and owns
+# the rooms whose ID maps to its index. The kernel spreads datagrams across the
+# workers by source address, so a worker that receives traffic for a room it
+# does not own forwards it over a local datagram link to the owner, which then
+# replies directly from its own socket on the same port. Which worker the kernel
+# picks changes whenever a worker restarts, so owners announce every client they
+# seat or unseat to all workers, and a restarted worker asks the others for theirs.
+WORKERS = 1
+worker_index = 0
+worker_links = []  # worker_links[i] delivers a datagram to worker i
+worker_inbox = None  # Our end of worker_links[worker_index]
+routes = {}  # client_addr -> index of the worker owning the client's room
+# Messages on the worker links, each starting with its kind
+LINK_FORWARD = 0x00  # Client datagram: original client IPv4 address and port, then the datagram
+LINK_ROUTE = 0x01  # Client seated or unseated by the sending worker: IPv4 address, port, sender, seated
+LINK_HELLO = 0x02  # Sending worker (re)started without rooms and wants the routes of the others: sender
+FORWARD_HEADER = struct.Struct('!B4sH')
+ROUTE_MESSAGE = struct.Struct('!B4sHBB')
+HELLO_MESSAGE = struct.Struct('!BB')
+
+class Session:
+    """A client seated in a room, indexed by address in sessions and Room.clients, and by role in Room.seats."""
+    __slots__ = ('addr', 'room', 'role', 'sequenced', 'ack', 'last_seen', 'idle_timer')
+
+    def __init__(self, addr, room, role, sequenced):
+        self.addr = addr
+        self.room = room
+        self.role = role  # Player, NONE for watchers
+        self.sequenced = sequenced  # Whether the client receives keyframe/delta updates instead of 0x80
+        self.ack = None  # ID of the client's last processed move input, None until it sent one
+        self.last_seen = time.monotonic()  # Time of the client's last datagram
+        self.idle_timer = None
+
+class Bucket:
+    """Token bucket of one address and opcode."""
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp  # Time tokens was last brought up to date
+
+class Room:
+    """A single match: its own game instance, client table and lifecycle."""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.game = game_pool.pop() if game_pool else Game(MAP_PATH)
+        self.clients = {}  # client_addr -> Session
+        self.seats = {}  # Player -> Session of the client or bot playing it
+        self.ended = False  # Match is over and the room only waits to be torn down
+        self.closed = False  # Torn down, its game may already be playing in another room
+        # Moves waiting for the next tick, only used when TICK_RATE is set
+        self.moves = {Player.CMAN: deque(maxlen=MOVE_QUEUE_DEPTH), Player.SPIRIT: deque(maxlen=MOVE_QUEUE_DEPTH)}
+        self.seq = 0  # Sequence number of the last broadcast state
+        self.last_state = None  # Last broadcast state, deltas are encoded against it
+        self.force_keyframe = True  # Next broadcast must be a keyframe, e.g. because a client joined
+        self.resets = 0  # Broadcasts left that are keyframes starting a new sequence, see proto.KEYFRAME_RESET
+        # Unsequenced clients get 0x84 instead of 0x80 when the map is too big for it
+        self.wide = not proto.fits_update(self.game.board_dims, len(self.game.point_index))
+        self.bots = {}  # Player -> bot choosing the moves of that role
+        self.bot_timer = None  # Pending bot fill or bot move
+
+def get_room(room_id):
+    """Return the room with the given ID, creating it if needed."""
+    room = rooms.get(room_id)
+    if room is None:
+        room = rooms[room_id] = Room(room_id)
+        print(f"Room {room_id} created")
+    return room
+
+def close_room(room):
+    """Tear down a room and return its game instance to the pool."""
+    if room.closed:
+        return  # E.g. the last human left during the cooldown, before the delayed close fired
+    room.closed = True
+    for client_addr, session in room.clients.items():
+        if sessions.get(client_addr) is session:
+            del sessions[client_addr]
+            if WORKERS > 1:
+                announce_route(client_addr, False)
+        if session.idle_timer is not None:
+            session.idle_timer.cancel()
+    room.clients.clear()
+    room.seats.clear()
+    for queue in room.moves.values():
+        queue.clear()
+    ticking_rooms.discard(room)
+    dirty_rooms.discard(room)
+    room.bots.clear()
+    if room.bot_timer is not None:
+        room.bot_timer.cancel()
+        room.bot_timer = None
+    if rooms.get(room.room_id) is room:
+        del rooms[room.room_id]
+        if journal is not None:
+            journal.close(room.room_id)
+    if len(game_pool) < MAX_POOLED_GAMES:
+        room.game.restart_game()
+        game_pool.append(room.game)
+    print(f"Room {room.room_id} closed")
+
+def get_room_state(room):
+    """
+
+    Returns:
+
+    tuple: The room's state as broadcast to clients: (cman coords, spirit coords, attempts, collected mask)
+
+    """
+    game = room.game
+    seats = room.seats
     cords = game.get_current_players_coords()
-    c_coords = cords[Player.CMAN] if Player.CMAN in clients.values() else (0xFF, 0xFF)
-    s_coords = cords[Player.SPIRIT] if Player.SPIRIT in clients.values() else (0xFF, 0xFF)
-    # feeze is 0 if the player can send move requests, 1 otherwise
-    freeze = (clients[addr] == Player.NONE) or (not game.can_move(clients[addr]))
-    points = game.get_points()
-
-    # convert the points dict into bytes where each bit represents a point, 5 bytes for 40 points
-    collected = [0] * 5
-    # sort the points by their coordinates, lexigraphically
-    i = 0
-    for point in sorted(points.keys()):
-        if points[point] == 0:
-            collected[i//8] |= 1 << (i%8)
-        i += 1
-    
+    c_coords = cords[Player.CMAN] if Player.CMAN in seats else proto.NO_COORDS
+    s_coords = cords[Player.SPIRIT] if Player.SPIRIT in seats else proto.NO_COORDS
     lives, score = game.get_game_progress()
-    attempts = MAX_ATTEMPTS - lives
+    return c_coords, s_coords, MAX_ATTEMPTS - lives, game.get_collected_mask()
+
+def encode_game_update(state, wide=False):
+    """
+
+    Encode a 0x80 game state update, or 0x84 if wide is set, once for all of its recipients.
+
+    Returns:
+
+    tuple(bytes, bytes): The update message with the freeze byte cleared and set
+
+    """
+    if wide:
+        return proto.encode_wide_update(0, state), proto.encode_wide_update(1, state)
+    return proto.encode_update(0, state), proto.encode_update(1, state)
+
+def get_frozen_roles(game):
+    """Map each role to its freeze byte: 0 if it can send move requests, 1 otherwise."""
+    return {Player.NONE: 1, Player.CMAN: int(not game.can_move(Player.CMAN)),
+            Player.SPIRIT: int(not game.can_move(Player.SPIRIT))}
+
+def get_game_update(room, addr):
+    """Get the game update message for a client."""
+    session = room.clients[addr]
+    freeze = get_frozen_roles(room.game)[session.role]
+    if session.sequenced:
+        if room.resets:
+            freeze |= proto.KEYFRAME_RESET
+        return proto.encode_keyframe(room.seq, freeze, get_room_state(room), session.ack or 0)
+    return encode_game_update(get_room_state(room), room.wide)[freeze]
+
+def send_update_to_all(room):
+    """Send a game update message to all clients in a room, at the end of the current receive batch if any."""
+    if batching:
+        dirty_rooms.add(room)
+        return
+    broadcast_update(room)
+
+def broadcast_update(room):
+    """Send the room's current state to all of its clients now."""
+    state = get_room_state(room)
+    updates = encode_game_update(state, room.wide)
+    frozen = get_frozen_roles(room.game)
 
-    message = bytes([0x80, freeze, c_coords[0], c_coords[1], s_coords[0], s_coords[1], attempts] + collected)
-    return message
+    previous = room.last_state
+    room.seq = seq = (room.seq + 1) & 0xFFFF
+    room.last_state = state
+    sequenced = None  # Keyframe or delta, encoded for the first sequenced client
 
-def send_update_to_all():
-    """Send a game update message to all clients."""
-    for client_addr in clients.keys():
-        send_message(client_addr, get_game_update(client_addr))
+    for client_addr, session in room.clients.items():
+        freeze = frozen[session.role]
+        if session.sequenced:
+            if sequenced is None:
+                if room.resets:
+                    room.resets -= 1
+                    sequenced = (proto.encode_keyframe(seq, proto.KEYFRAME_RESET, state),
+                                 proto.encode_keyframe(seq, 1 | proto.KEYFRAME_RESET, state))
+                elif room.force_keyframe or seq % KEYFRAME_INTERVAL == 0 or previous[3] & ~state[3]:
+                    sequenced = (proto.encode_keyframe(seq, 0, state), proto.encode_keyframe(seq, 1, state))
+                else:
+                    sequenced = (proto.encode_delta(seq, 0, previous, state),
+                                 proto.encode_delta(seq, 1, previous, state))
+                room.force_keyframe = False
+            if session.ack is not None:
+                send_message(client_addr, proto.with_ack(sequenced[freeze], session.ack))
+            else:
+                send_message(client_addr, sequenced[freeze])
+        else:
+            send_message(client_addr, updates[freeze])
 
 def send_message(client_addr, message):
     """Send a message to a client."""
+    if client_addr[0] == BOT_HOST:
+        return  # Bots read the game state directly
     server_socket.sendto(message, client_addr)
+    if metrics is not None:
+        metrics.count_sent(message)
     
-def send_message_to_all(message):
-    """Send a message to all clients."""
-    for client_addr in clients:
+def send_message_to_all(room, message):
+    """Send a message to all clients in a room."""
+    for client_addr in room.clients:
         send_message(client_addr, message)
 
-def handle_join_request(client_addr, role):
+def seat_client(room, client_addr, player, flags):
+    """Record a client as seated in a room playing player, Player.NONE for watchers."""
+    if client_addr in room.clients:
+        unseat_client(room, client_addr)  # Joined the same room again, possibly in another role
+    session = Session(client_addr, room, player, bool(flags & proto.JOIN_SEQUENCED))
+    room.clients[client_addr] = sessions[client_addr] = session
+    if player != Player.NONE:
+        room.seats[player] = session
+    if WORKERS > 1:
+        announce_route(client_addr, True)
+    if session.sequenced:
+        room.force_keyframe = True
+    if IDLE_TIMEOUT and session.sequenced:
+        session.idle_timer = idle_timers.call_later(IDLE_TIMEOUT, expire_session, session)
+    if journal is not None:
+        journal.join(room.room_id, player, flags, client_addr)
+    print(f"Client {client_addr} joined room {room.room_id} as {player}")
+
+def unseat_client(room, client_addr):
+    """Remove a client's session from a room."""
+    session = room.clients.pop(client_addr)
+    if room.seats.get(session.role) is session:
+        del room.seats[session.role]
+    if sessions.get(client_addr) is session:
+        del sessions[client_addr]
+        if WORKERS > 1:
+            announce_route(client_addr, False)
+    if session.idle_timer is not None:
+        session.idle_timer.cancel()
+        session.idle_timer = None
+    if journal is not None:
+        journal.quit(room.room_id, client_addr)
+
+def expire_session(session):
+    """Evict a client that sent nothing for IDLE_TIMEOUT seconds, as if it had quit."""
+    session.idle_timer = None
+    room = session.room
+    if room.clients.get(session.addr) is not session:
+        return
+    idle = time.monotonic() - session.last_seen
+    if idle >= IDLE_TIMEOUT and not room.ended:
+        print(f"Client {session.addr} idle for {idle:.0f}s, evicting it from room {room.room_id}")
+        previous_state = room.game.state
+        handle_exit_request(session.addr)
+        check_room_state(room, previous_state)
+        idle = 0
+    if room.clients.get(session.addr) is session:
+        # Active since the timer was set, or still seated, check again once it could have expired
+        session.idle_timer = idle_timers.call_later(IDLE_TIMEOUT - idle, expire_session, session)
+
+def sweep_idle_sessions():
+    """Expire the idle timers that are due, every IDLE_RESOLUTION seconds."""
+    idle_timers.advance()
+    schedule(IDLE_RESOLUTION, sweep_idle_sessions)
+
+def handle_join_request(client_addr, role, room_id=DEFAULT_ROOM, flags=0):
     """Handles a join request from a client."""
-    if role in [0,1,2]:
-        if role == 0:
-            clients[client_addr] = roles[role]
-            send_message(client_addr, get_game_update(client_addr))
-            print(f"Client {client_addr} joined as {roles[role]}")
-        if role == 1:
-            if Player.CMAN in clients.values():
-                # CMAN already taken, send error message
-                #send_message(client_addr, get_game_update(client_addr))
-                send_message(client_addr, bytes([0xFF, 0x03]))
-            else:
-                clients[client_addr] = roles[role]
-                print(f"Client {client_addr} joined as {roles[role]}")
-                send_update_to_all()
-        if role == 2:
-            if Player.SPIRIT in clients.values():
-                # SPIRIT already taken, send error message
-                #send_message(client_addr, get_game_update(client_addr))
-                send_message(client_addr, bytes([0xFF, 0x04]))
-            else:
-                clients[client_addr] = roles[role]
-                print(f"Client {client_addr} joined as {roles[role]}")
-                send_update_to_all()
-    else:
+    if role not in [0,1,2]:
         # error message
         send_message(client_addr, bytes([0xFF, 0x05]))
         return
-    
-    if Player.CMAN in clients.values() and Player.SPIRIT in clients.values():
+
+    current = sessions.get(client_addr)
+    if current is not None and current.room.room_id != room_id:
+        leave_room(current)  # A client is seated in one room at a time, leave the old one first
+
+    if role == 0 and RELAYS and flags & proto.JOIN_REDIRECT and not flags & proto.JOIN_RELAY:
+        send_message(client_addr, proto.encode_redirect(RELAYS[room_id % len(RELAYS)]))
+        return
+
+    room = get_room(room_id)
+    seats = room.seats
+    if role == 0:
+        seat_client(room, client_addr, roles[role], flags)
+        send_message(client_addr, get_game_update(room, client_addr))
+    if role == 1:
+        if Player.CMAN in seats:
+            # CMAN already taken, send error message
+            send_message(client_addr, bytes([0xFF, 0x03]))
+        else:
+            seat_client(room, client_addr, roles[role], flags)
+            send_update_to_all(room)
+    if role == 2:
+        if Player.SPIRIT in seats:
+            # SPIRIT already taken, send error message
+            send_message(client_addr, bytes([0xFF, 0x04]))
+        else:
+            seat_client(room, client_addr, roles[role], flags)
+            send_update_to_all(room)
+
+    if Player.CMAN in seats and Player.SPIRIT in seats:
         # Start the game if both roles are taken
-        if game.state == State.WAIT:
-            game.state = State.START
-            print("start the game")
-  
-    # Send the game state update to the client
+        if room.game.state == State.WAIT:
+            start_game(room)
+    elif BOT_ROLES and room.bot_timer is None and client_addr in room.clients:
+        room.bot_timer = schedule(BOT_FILL_DELAY, fill_with_bots, room)
 
-    
-    
+def start_game(room):
+    """Let the game of a room start, both roles being taken."""
+    room.game.state = State.START
+    if journal is not None:
+        journal.start(room.room_id)
+    print(f"Room {room.room_id}: start the game")
 
-def handle_move_request(client_addr, direction):
-    """Handle a move request from a client."""
-    role = clients[client_addr]
+def seat_bot(room, role):
+    """Seat a bot playing role in a room."""
+    addr = (BOT_HOST, int(role))
+    room.clients[addr] = room.seats[role] = Session(addr, room, role, False)  # Never idle, bots are not in sessions
+    room.bots[role] = cman_bot.BOTS[role](room.game)
+
+def fill_with_bots(room):
+    """Seat bots in the BOT_ROLES of a waiting room that no human took, and start them moving."""
+    room.bot_timer = None
+    if room.ended or rooms.get(room.room_id) is not room or room.game.state != State.WAIT:
+        return
+    seats = room.seats
+    for role in BOT_ROLES:
+        if role not in seats:
+            seat_bot(room, role)
+            if journal is not None:
+                journal.bot(room.room_id, role)
+            print(f"Bot joined room {room.room_id} as {role}")
+    if Player.CMAN in seats and Player.SPIRIT in seats:
+        start_game(room)
+    send_update_to_all(room)
+    if room.bots:
+        room.bot_timer = schedule(1 / BOT_MOVE_RATE, run_bots, room)
+
+def run_bots(room):
+    """Let every bot of a room make its next move."""
+    room.bot_timer = None
+    if room.ended or rooms.get(room.room_id) is not room:
+        return
+    game = room.game
+    previous_state = game.state
+    for role, bot in room.bots.items():
+        if game.can_move(role):
+            direction = bot.choose_move(game)
+            if direction is not None:
+                move_player(room, (BOT_HOST, int(role)), role, direction)
+    check_room_state(room, previous_state)
+    if not room.ended and rooms.get(room.room_id) is room:
+        room.bot_timer = schedule(1 / BOT_MOVE_RATE, run_bots, room)
+
+def handle_move_request(client_addr, direction, input_id=None):
+    """Handle a move request from a client, acknowledging input_id once it is processed."""
+    session = sessions.get(client_addr)
+    if session is None:
+        return
+    if session.role == Player.NONE:
+        return  # Watchers cannot move
+    move_player(session.room, client_addr, session.role, direction, input_id)
+
+def move_player(room, client_addr, role, direction, input_id=None):
+    """Apply or queue the move of a seated player and broadcast its effect."""
+    game = room.game
+    if (TICK_RATE or room.moves[role]) and game.can_move(role):
+        # Without TICK_RATE only moves queued over the rate limit tick, later moves wait behind them
+        queue_move(room, client_addr, role, direction, input_id)
+        return
+    if input_id is not None:
+        room.clients[client_addr].ack = input_id
 
     if game.state == State.WAIT:
         send_message(client_addr, bytes([0xFF, 0x00]))  # Error opcode, code 0x02 (waiting for players)
-    elif game.state == State.START and roles[clients[client_addr]] == Player.SPIRIT:
+    elif game.state == State.START and role == Player.SPIRIT:
         send_message(client_addr, bytes([0xFF, 0x01]))
-    
+
+
     elif game.apply_move(role, direction):
-        send_update_to_all()
+        if journal is not None:
+            journal.move(room.room_id, role, direction)
+        send_update_to_all(room)
         return 
 
-    
-    
+def leave_room(session):
+    """Take a client out of its room before it is seated in another one, an ended room closes on its own."""
+    room = session.room
+    if not room.ended:
+        previous_state = room.game.state
+        handle_exit_request(session.addr)
+        check_room_state(room, previous_state)
+
 def handle_exit_request(client_addr):
     """Handles a client exit request."""
-    if client_addr in clients.keys():
-        role = clients[client_addr]
+    session = sessions.get(client_addr)
+    if session is not None:
+        room = session.room
+        game = room.game
+        clients = room.clients
+        role = session.role
 
-        if role == Player.CMAN or role == Player.SPIRIT:
+        if role == Player.NONE:
+            # Watchers, relays among them, stop receiving updates
+            unseat_client(room, client_addr)
+            print(f"Watcher {client_addr} exited room {room.room_id}")
+        elif role == Player.CMAN or role == Player.SPIRIT:
             if game.state == State.WAIT:
-                clients.pop(client_addr)
-                print(f"Client {client_addr} exited")
-                send_update_to_all()
-            elif Player.CMAN in clients.values() and Player.SPIRIT in clients.values():
-                clients.pop(client_addr)
+                unseat_client(room, client_addr)
+                print(f"Client {client_addr} exited room {room.room_id}")
+                if clients:
+                    send_update_to_all(room)
+            elif Player.CMAN in room.seats and Player.SPIRIT in room.seats:
+                unseat_client(room, client_addr)
                 winner = Player.SPIRIT if role == Player.CMAN else Player.CMAN
                 game.declare_winner(winner)
-                print(f"Client {client_addr} exited, winner: {role}")
+                if journal is not None:
+                    journal.winner(room.room_id, winner)
+                print(f"Client {client_addr} exited room {room.room_id}, winner: {role}")
+        if all(addr[0] == BOT_HOST for addr in clients):
+            close_room(room)  # Bots do not keep a room alive on their own
 
     else:
         send_message(client_addr, bytes([0xFF, 0x03]))  # Error opcode, code 0x03 (not in game)
 
-def flush_socket(socket):
-    """Flush the socket of all messages."""
-    while True:
+def end_game(room):
+    """Announce the winner of a finished match and tear its room down."""
+    if room.ended:
+        return
+    room.ended = True
+    game = room.game
+    winner = game.get_winner()
+    winner_byte = 1 if winner == Player.CMAN else 2
+    print(f"Room {room.room_id}: game ended, winner: {winner}")
+    c_score = MAX_ATTEMPTS - game.get_game_progress()[0]
+    s_score = game.get_game_progress()[1]
+    dirty_rooms.discard(room)
+    broadcast_update(room)  # Never deferred, the final state has to arrive before 0x8F
+    send_message_to_all(room, bytes([0x8F, winner_byte, s_score, c_score]))  # Game end message
+    # Traffic for the room is dropped until the delay expires, see the RECEIVERS handlers
+    schedule(GAME_END_DELAY, close_room, room)
+
+def schedule(delay, callback, *args):
+    """Run callback(*args) after delay seconds on the active engine's timers."""
+    if event_loop is not None:
+        return event_loop.call_later(delay, callback, *args)
+    return timers.call_later(delay, callback, *args)
+
+
+def check_room_state(room, previous_state):
+    """Broadcast state transitions of a room and end its match once won."""
+    if rooms.get(room.room_id) is not room:
+        return  # Room was torn down while handling the request
+    # Continue to check for clients and update the game state
+    if room.game.state != previous_state:
+        send_update_to_all(room)  # Game state update
+    # If game ends
+    if room.game.state == State.WIN:
+        end_game(room)
+
+def queue_move(room, client_addr, role, direction, input_id):
+    """Queue a move to be applied at the next tick."""
+    global tick_timer
+    queue = room.moves[role]
+    if queue and queue[-1][0] == direction:
+        # Key repeats of a held direction collapse into a single step per tick
+        if input_id is not None:
+            queue[-1][2] = input_id
+        return
+    queue.append([direction, client_addr, input_id])
+    ticking_rooms.add(room)
+    if tick_timer is None:
+        period = tick_period()
+        tick_timer = schedule(period - time.monotonic() % period, run_tick)
+
+def tick_period():
+    """Seconds between ticks, at the move rate limit when only moves queued over the limit tick."""
+    return 1 / (TICK_RATE or RATE_LIMITS[0x01][0])
+
+def run_tick():
+    """Apply one queued move per player in every ticking room and broadcast each room once."""
+    global tick_timer
+    tick_timer = None
+    for room in list(ticking_rooms):
+        if room.ended or rooms.get(room.room_id) is not room:
+            ticking_rooms.discard(room)
+            continue
+        game = room.game
+        previous_state = game.state
+        changed = False
+        for role, queue in room.moves.items():
+            if queue:
+                direction, client_addr, input_id = queue.popleft()
+                session = room.clients.get(client_addr)
+                if input_id is not None and session is not None:
+                    session.ack = input_id
+                if game.apply_move(role, direction):
+                    if journal is not None:
+                        journal.move(room.room_id, role, direction)
+                    changed = True
+        if not (room.moves[Player.CMAN] or room.moves[Player.SPIRIT]):
+            ticking_rooms.discard(room)
+        if changed and game.state == previous_state:
+            send_update_to_all(room)
+        check_room_state(room, previous_state)
+    if ticking_rooms:
+        period = tick_period()
+        tick_timer = schedule(period - time.monotonic() % period, run_tick)
+
+# Traffic for a room whose match has ended is dropped until the room is torn down
+
+def receive_join(data, client_addr, session):
+    """Join request (0x00): role byte, then the optional room ID and join flags."""
+    if len(data) < 2:
+        return
+    room_id = data[2] << 8 | data[3] if len(data) >= 4 else DEFAULT_ROOM
+    room = rooms.get(room_id)
+    if room is not None and room.ended:
+        return
+    previous_state = room.game.state if room is not None else State.WAIT
+    handle_join_request(client_addr, data[1], room_id, data[4] if len(data) >= 5 else 0)
+    session = sessions.get(client_addr)
+    if session is not None:
+        check_room_state(session.room, previous_state)
+
+def receive_move(data, client_addr, session):
+    """Move request (0x01): direction byte, then the optional input ID."""
+    if session is None or session.room.ended or len(data) < 2 or data[1] >= len(DIRECTIONS):
+        return
+    room = session.room
+    previous_state = room.game.state
+    handle_move_request(client_addr, DIRECTIONS[data[1]], data[2] << 8 | data[3] if len(data) >= 4 else None)
+    check_room_state(room, previous_state)
+
+def receive_keepalive(data, client_addr, session):
+    """Keepalive (0x02), refreshes the client's session and makes it evictable once idle."""
+    if IDLE_TIMEOUT and session is not None and session.idle_timer is None \
+            and session.room.clients.get(client_addr) is session:
+        session.idle_timer = idle_timers.call_later(IDLE_TIMEOUT, expire_session, session)
+
+def receive_quit(data, client_addr, session):
+    """Quit request (0x0F)."""
+    room = session.room if session is not None else None
+    if room is not None and room.ended:
+        return
+    previous_state = room.game.state if room is not None else State.WAIT
+    handle_exit_request(client_addr)
+    if room is not None:
+        check_room_state(room, previous_state)
+
+def take_token(client_addr, opcode):
+    """Returns whether client_addr is within the rate limit of opcode, taking a token from its bucket if so."""
+    rate, burst = RATE_LIMITS[opcode]
+    now = time.monotonic()
+    key = (client_addr, opcode)
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = Bucket(burst - 1, now)
+        return True
+    tokens = bucket.tokens + (now - bucket.stamp) * rate
+    if tokens > burst:
+        tokens = burst
+    bucket.stamp = now
+    if tokens >= 1:
+        bucket.tokens = tokens - 1
+        return True
+    bucket.tokens = tokens
+    return False
+
+def defer_move(data, client_addr, session):
+    """Queue a move over the rate limit for the next tick, if it would be accepted now."""
+    if session is None or session.room.ended or len(data) < 2 or data[1] >= len(DIRECTIONS):
+        return
+    if session.role != Player.NONE and session.room.game.can_move(session.role):
+        queue_move(session.room, client_addr, session.role, DIRECTIONS[data[1]],
+                   data[2] << 8 | data[3] if len(data) >= 4 else None)
+
+def sweep_rate_limits():
+    """Forget the buckets that are full again, they act like new ones, every RATE_SWEEP_INTERVAL seconds."""
+    now = time.monotonic()
+    for key in [key for key, bucket in buckets.items()
+                if bucket.tokens + (now - bucket.stamp) * RATE_LIMITS[key[1]][0] >= RATE_LIMITS[key[1]][1]]:
+        del buckets[key]
+    schedule(RATE_SWEEP_INTERVAL, sweep_rate_limits)
+
+RECEIVERS = {0x00: receive_join, 0x01: receive_move, proto.KEEPALIVE: receive_keepalive, 0x0F: receive_quit}  # Opcode -> handler of its datagrams
+
+def handle_datagram(data, client_addr):
+    """Dispatch a single datagram to the handler of its opcode."""
+    if not data:
+        return
+    if metrics is not None:
+        metrics.count_received(data)
+    opcode = data[0]
+    receive = RECEIVERS.get(opcode)
+    if receive is not None:
+        session = sessions.get(client_addr)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        if opcode in RATE_LIMITS and not take_token(client_addr, opcode):
+            if metrics is not None:
+                metrics.count_limited(opcode)
+            if QUEUE_EXCESS_MOVES and opcode == 0x01:
+                defer_move(data, client_addr, session)
+            return
+        receive(data, client_addr, session)
+
+def receive_datagrams():
+    """Handle the datagrams waiting on the server socket, at most RECV_BATCH of them."""
+    for _ in range(RECV_BATCH):
         try:
-            socket.recv(1024)
+            size, client_addr = server_socket.recvfrom_into(recv_buffer)
         except BlockingIOError:
-            break
+            return
+        # Handlers only read the datagram, so it is passed as a view of the reused buffer
+        route_datagram(recv_view[:size], client_addr)
 
+def flush_updates():
+    """Send the broadcasts deferred by the last receive batch."""
+    while dirty_rooms:
+        room = dirty_rooms.pop()
+        if rooms.get(room.room_id) is room:
+            broadcast_update(room)
 
-def main():
-    global game, server_socket, clients
+def room_owner(room_id):
+    """Return the index of the worker that hosts a room."""
+    return room_id % WORKERS
+
+def route_datagram(data, client_addr):
+    """Handle a datagram locally or forward it to the worker owning its room."""
+    if WORKERS > 1 and data:
+        if data[0] == 0x00:  # Join request, the room ID decides the owner
+            room_id = int.from_bytes(data[2:4], 'big') if len(data) >= 4 else DEFAULT_ROOM
+            owner = routes[client_addr] = room_owner(room_id)
+        elif data[0] == 0x0F:  # Quit request, the route is no longer needed
+            owner = routes.pop(client_addr, worker_index)
+        else:
+            owner = routes.get(client_addr, worker_index)
+        if owner != worker_index:
+            header = FORWARD_HEADER.pack(LINK_FORWARD, socket.inet_aton(client_addr[0]), client_addr[1])
+            worker_links[owner].send(header + data)
+            return
+        handle_owned_datagram(data, client_addr)
+        return
+    handle_datagram(data, client_addr)
+
+def handle_owned_datagram(data, client_addr):
+    """Handle a datagram of a room this worker owns."""
+    handle_datagram(data, client_addr)
+    if data[0] == 0x00 and client_addr not in sessions:
+        announce_route(client_addr, False)  # Join refused, drop the route its receiver assumed
+
+def announce_route(client_addr, seated):
+    """Tell every worker, this one included, whether a client is seated in a room of this worker."""
+    message = ROUTE_MESSAGE.pack(LINK_ROUTE, socket.inet_aton(client_addr[0]), client_addr[1], worker_index, seated)
+    update_route(client_addr, worker_index, seated)
+    for i, link in enumerate(worker_links):
+        if i != worker_index:
+            link.send(message)
+
+def update_route(client_addr, owner, seated):
+    if seated:
+        routes[client_addr] = owner
+    elif routes.get(client_addr) == owner:
+        del routes[client_addr]  # Unless the client joined a room of another worker since
+
+def announce_worker():
+    """Ask the other workers for the routes of their clients, this worker starts without any."""
+    message = HELLO_MESSAGE.pack(LINK_HELLO, worker_index)
+    for i, link in enumerate(worker_links):
+        if i != worker_index:
+            link.send(message)
+
+def receive_forwarded():
+    """Handle the messages of other workers, at most RECV_BATCH of them."""
+    for _ in range(RECV_BATCH):
+        try:
+            size = worker_inbox.recv_into(recv_buffer)
+        except BlockingIOError:
+            return
+        kind = recv_buffer[0]
+        if kind == LINK_FORWARD:
+            _, ip, port = FORWARD_HEADER.unpack_from(recv_buffer)
+            handle_owned_datagram(recv_view[FORWARD_HEADER.size:size], (socket.inet_ntoa(ip), port))
+        elif kind == LINK_ROUTE:
+            _, ip, port, owner, seated = ROUTE_MESSAGE.unpack_from(recv_buffer)
+            client_addr = (socket.inet_ntoa(ip), port)
+            session = sessions.get(client_addr)
+            if seated and session is not None:
+                leave_room(session)  # Joined a room of another worker, as handle_join_request does locally
+            update_route(client_addr, owner, seated)
+        elif kind == LINK_HELLO:
+            _, restarted = HELLO_MESSAGE.unpack_from(recv_buffer)
+            for client_addr in [addr for addr, owner in routes.items() if owner == restarted]:
+                del routes[client_addr]  # Its rooms died with it
+            for client_addr in sessions:
+                worker_links[restarted].send(ROUTE_MESSAGE.pack(
+                    LINK_ROUTE, socket.inet_aton(client_addr[0]), client_addr[1], worker_index, True))
+
+def enable_metrics():
+    """Start collecting metrics and listen for scrapes on METRICS_SOCKET."""
+    global metrics, metrics_listener
+    metrics = cman_metrics.Metrics()
+    for name in TIMED_FUNCTIONS:
+        # Handlers are looked up in the module globals on every call, so wrapping them here times every caller
+        globals()[name] = metrics.timed(globals()[name])
+    metrics.gauge("cman_rooms", "Rooms hosted by this process", lambda: len(rooms))
+    metrics.gauge("cman_clients", "Clients seated in a room of this process", lambda: len(sessions))
+    if ENGINE == 'asyncio':
+        metrics.loop = False  # Its loop runs inside asyncio, which has no hook for wake-ups
+        metrics.gauge("cman_pending_timers", "Scheduled callbacks of the asyncio loop",
+                      lambda: sum(not handle.cancelled() for handle in event_loop._scheduled) if event_loop else 0)
+    else:
+        metrics.gauge("cman_pending_timers", "Scheduled callbacks of the select engine", lambda: len(timers))
+    metrics.gauge("cman_rate_limit_buckets", "Token buckets of addresses that sent recently", lambda: len(buckets))
+    path = METRICS_SOCKET if WORKERS == 1 else f"{METRICS_SOCKET}.{worker_index}"
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from a previous run
+    metrics_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    metrics_listener.bind(path)
+    metrics_listener.listen()
+    metrics_listener.setblocking(False)
+
+def serve_metrics():
+    """Write the current metrics to a scraper that connected to the metrics socket."""
+    try:
+        conn, _ = metrics_listener.accept()
+    except BlockingIOError:
+        return
+    with conn:
+        conn.settimeout(1)
+        try:
+            conn.sendall(metrics.render().encode())
+        except OSError:
+            pass  # Scraper went away
+
+def open_journal():
+    """Start this process's journal, first rebuilding the rooms it describes when RECOVER is set."""
+    global journal
+    path = JOURNAL_PATH if WORKERS == 1 else f"{JOURNAL_PATH}.{worker_index}"
+    cmap = gm.load_map(MAP_PATH, MAP_CACHE)
+    if RECOVER and os.path.exists(path):
+        with open(path, 'rb') as f:
+            replayed_rooms = cman_journal.replay(f.read(), cmap)
+        for replayed in replayed_rooms.values():
+            if replayed.game.state == State.WIN:
+                continue  # Finished match, its end was already announced
+            room = rooms[replayed.room_id] = Room(replayed.room_id)
+            room.game = replayed.game
+            # The clients saw sequence numbers of the previous run, the first broadcasts restart their sequence
+            room.resets = KEYFRAME_INTERVAL
+            for client_addr, (player, flags) in replayed.clients.items():
+                seat_client(room, client_addr, player, flags)
+            for player in replayed.bots:
+                seat_bot(room, player)
+            print(f"Room {room.room_id} recovered with {len(room.clients)} clients, state {room.game.state.name}")
+    # The new journal starts with a snapshot of the recovered rooms, so it never replays the old moves again
+    snapshot = [(room.room_id, room.game, [(addr, session.role, proto.JOIN_SEQUENCED if session.sequenced else 0)
+                                           for addr, session in room.clients.items() if addr[0] != BOT_HOST],
+                 list(room.bots)) for room in rooms.values()]
+    journal = cman_journal.Journal(path, cmap, snapshot)
+
+def schedule_journal_flush():
+    """Write the journal buffer every FLUSH_INTERVAL seconds, keeping file I/O out of the request handlers."""
+    journal.flush()
+    schedule(cman_journal.FLUSH_INTERVAL, schedule_journal_flush)
+
+def server_started():
+    """Announce the server, then send recovered rooms their state and start the timers of this process."""
+    print_started()
+    for room in list(rooms.values()):
+        send_update_to_all(room)
+        if room.bots:
+            room.bot_timer = schedule(1 / BOT_MOVE_RATE, run_bots, room)
+    if journal is not None:
+        schedule_journal_flush()
+    if IDLE_TIMEOUT:
+        schedule(IDLE_RESOLUTION, sweep_idle_sessions)
+    if RATE_LIMITS:
+        schedule(RATE_SWEEP_INTERVAL, sweep_rate_limits)
+
+def open_server_socket():
+    """Create the non-blocking UDP socket of this process."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if WORKERS > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((SERVER_IP, SERVER_PORT))
+    sock.setblocking(False)  # Non-blocking mode
+    return sock
+
+def print_started():
+    """Announce that this process is ready for clients."""
+    if WORKERS > 1:
+        print(f"Worker {worker_index} started, waiting for clients...")
+    else:
+        print("Server started, waiting for clients...")
+
+def serve_select():
+    """Run the select() based server loop of this process."""
+    global server_socket, batching
     # UDP server socket setup
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.bind((SERVER_IP, SERVER_PORT))
-    server_socket.setblocking(False)  # Non-blocking mode
-    # Initialize the game with the map file
-    game = Game("map.txt")
-    
-    print("Server started, waiting for clients...")
+    server_socket = open_server_socket()
+    sockets = [server_socket] if worker_inbox is None else [server_socket, worker_inbox]
+    if worker_inbox is not None:
+        worker_inbox.setblocking(False)
+    if metrics_listener is not None:
+        sockets.append(metrics_listener)
+    server_started()
 
     while True:
-        # Use select to handle multiple clients without blocking
-        previous_state = game.state
-        readable, _, _ = select.select([server_socket], [], [], TIMEOUT)
-        
-        for sock in readable:
-            if sock is server_socket:
-                # Receive data from clients
-                data, client_addr = server_socket.recvfrom(1024)
-                if not data:
-                    continue
-                
-                opcode = data[0]
-                
-
-                if opcode == 0x00:  # Join request
-                    role = data[1]  # Role byte
-                    handle_join_request(client_addr, role)
-                
-                elif opcode == 0x01:  # Player move request
-                    direction = Direction(data[1])  # Direction byte
-                    handle_move_request(client_addr, direction)
-                    
-                
-                elif opcode == 0x0F:  # Quit request
-                    handle_exit_request(client_addr)
-        
-
-        # Continue to check for clients and update the game state
-        if game.state != previous_state:
-            send_update_to_all()  # Game state update
-        # If game ends
-        if game.state == State.WIN:
-            winner = game.get_winner()
-            winner_byte = 1 if winner == Player.CMAN else 2
-            print(f"Game ended, winner: {winner}")
-            c_score = MAX_ATTEMPTS - game.get_game_progress()[0]
-            s_score = game.get_game_progress()[1]
-            send_update_to_all()
-            send_message_to_all(bytes([0x8F, winner_byte, s_score, c_score]))  # Game end message
-            time.sleep(10)  # Wait for a few seconds before restarting
-            flush_socket(server_socket)
-            clients.clear()
-            game.restart_game()  # Restart the game after a winner is declared
-            print("Game restarted, waiting for clients...")
+        # Use select to handle multiple clients, sleeping until I/O or the next timer
+        readable, _, _ = select.select(sockets, [], [], timers.timeout())
+        if metrics is not None:
+            metrics.wakeups += 1
+            woke = time.perf_counter_ns()
+
+        batching = True
+        try:
+            for sock in readable:
+                if sock is server_socket:
+                    receive_datagrams()  # Drain the datagrams of clients
+                elif sock is worker_inbox:
+                    receive_forwarded()
+                elif sock is metrics_listener:
+                    serve_metrics()
+        finally:
+            batching = False
+            flush_updates()
+        timers.run_expired()
+        if metrics is not None:
+            metrics.iteration.observe(time.perf_counter_ns() - woke)
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams from the asyncio transport into the request handlers."""
+
+    def connection_made(self, transport):
+        global server_socket
+        server_socket = transport
+
+    def datagram_received(self, data, addr):
+        route_datagram(data, addr)
+
+async def serve_asyncio_forever():
+    """Serve clients from the running asyncio loop until cancelled."""
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    transport, _ = await event_loop.create_datagram_endpoint(ServerProtocol, sock=open_server_socket())
+    if worker_inbox is not None:
+        worker_inbox.setblocking(False)
+        event_loop.add_reader(worker_inbox, receive_forwarded)
+    if metrics_listener is not None:
+        event_loop.add_reader(metrics_listener, serve_metrics)
+    server_started()
+    try:
+        await asyncio.Future()  # The loop now only wakes up for I/O and timers
+    finally:
+        transport.close()
+
+def serve_asyncio():
+    """Run the asyncio based server loop of this process."""
+    asyncio.run(serve_asyncio_forever())
+
+def serve():
+    """Set up the optional metrics and journal of this process, then run its server loop."""
+    if hasattr(signal, 'SIGUSR1'):  # Not on Windows, which then runs without the profiler
+        prefix = f"cman-{os.getpid()}" if WORKERS == 1 else f"cman-worker{worker_index}"
+        cman_profiler.Profiler(PROFILE_DIR, prefix).install()
+    if METRICS_SOCKET is not None:
+        enable_metrics()
+    if WORKERS > 1:
+        announce_worker()  # Before recovery announces its clients, the others drop our old routes on the hello
+    if JOURNAL_PATH is not None:
+        open_journal()
+    try:
+        serve_engine()
+    finally:
+        if journal is not None:
+            journal.flush()
+
+def serve_engine():
+    """Run the server loop selected by ENGINE."""
+    if ENGINE == 'asyncio':
+        serve_asyncio()
+    else:
+        serve_select()
+
+def spawn_worker(index, links):
+    """Fork a worker process serving the rooms owned by index."""
+    global worker_index, worker_links, worker_inbox
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    worker_index = index
+    worker_links = [send_end for _, send_end in links]
+    worker_inbox = links[index][0]
+    for i, (inbox, _) in enumerate(links):
+        if i != index:
+            inbox.close()
+    try:
+        serve()
+    finally:
+        os._exit(1)
+
+def run_workers():
+    """Supervise WORKERS worker processes, restarting any that die."""
+    links = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(WORKERS)]
+    workers = {spawn_worker(i, links): i for i in range(WORKERS)}
+
+    def stop(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    def forward(signum, frame):
+        for pid in workers:
+            os.kill(pid, signum)
+    signal.signal(signal.SIGUSR1, forward)  # Profile every worker
+    signal.signal(signal.SIGUSR2, forward)
+    print(f"Supervisor started {WORKERS} workers on port {SERVER_PORT}")
+
+    while True:
+        pid, status = os.wait()
+        index = workers.pop(pid, None)
+        if index is not None:
+            print(f"Worker {index} exited with status {status}, restarting")
+            workers[spawn_worker(index, links)] = index
+
+def main():
+    # Compile the map once before any room or worker exists, every Game then shares it
+    cmap = gm.load_map(MAP_PATH, MAP_CACHE)
+    if BOT_ROLES and len(cmap.board) > cman_bot.MAX_CELLS:
+        print(f"Bots only play maps of up to {cman_bot.MAX_CELLS} cells, {MAP_PATH} has {len(cmap.board)}. Exiting.")
+        sys.exit(1)
+    if BOT_ROLES:
+        # Build the path tables up front, so workers inherit them and no match stalls on the first bot fill
+        cman_bot.get_path_tables(Game(MAP_PATH))
+    if WORKERS > 1:
+        run_workers()
+    else:
+        serve()
 
 if __name__ == "__main__":
-    # get port from args of given
-    if len(sys.argv) > 1:
-        SERVER_PORT = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description="C-Man game server")
+    parser.add_argument('port', nargs='?', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="number of SO_REUSEPORT worker processes sharing the port")
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default=ENGINE,
+                        help="server loop implementation")
+    parser.add_argument('--map', default=MAP_PATH, help="textual map file played in every room")
+    parser.add_argument('--map-cache', metavar='FILE', default=MAP_CACHE,
+                        help="compiled map file, written on first use and mmapped on later starts")
+    parser.add_argument('--metrics-socket', metavar='PATH', default=METRICS_SOCKET,
+                        help="collect metrics and serve them as text on this UNIX socket")
+    parser.add_argument('--profile-dir', metavar='DIR', default=PROFILE_DIR,
+                        help="write the profiles toggled by SIGUSR1 (stack samples) and SIGUSR2 (allocations) here")
+    parser.add_argument('--journal', metavar='PATH', default=JOURNAL_PATH,
+                        help="journal accepted moves, joins and quits to this file")
+    parser.add_argument('--recover', action='store_true', help="resume the live matches of the journal")
+    parser.add_argument('--bots', nargs='+', choices=['cman', 'spirit'], default=[],
+                        help="roles that server-side bots fill when no human takes them")
+    parser.add_argument('--bot-delay', type=float, default=BOT_FILL_DELAY,
+                        help="seconds a room waits for human players before bots join")
+    parser.add_argument('--bot-rate', type=float, default=BOT_MOVE_RATE, help="moves per second of each bot")
+    parser.add_argument('--relay', metavar='HOST:PORT', action='append', default=[],
+                        help="redirect watchers to this spectator relay, may be given several times")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="evict clients that sent nothing for this many seconds (0 disables)")
+    parser.add_argument('--join-limit', type=float, default=JOIN_RATE_LIMIT,
+                        help="joins per second allowed from one address (0 disables the limit)")
+    parser.add_argument('--move-limit', type=float, default=MOVE_RATE_LIMIT,
+                        help="moves per second allowed from one address (0 disables the limit)")
+    parser.add_argument('--queue-excess-moves', action='store_true',
+                        help="queue moves over the limit for the next tick instead of dropping them")
+    parser.add_argument('--tick-rate', type=float, default=TICK_RATE,
+                        help="apply queued moves and broadcast at this many ticks per second (0 disables)")
+    args = parser.parse_args()
+    SERVER_PORT = args.port
+    WORKERS = max(1, args.workers)
+    ENGINE = args.engine
+    MAP_PATH = args.map
+    MAP_CACHE = args.map_cache
+    METRICS_SOCKET = args.metrics_socket
+    PROFILE_DIR = args.profile_dir
+    JOURNAL_PATH = args.journal
+    RECOVER = args.recover
+    TICK_RATE = max(0, args.tick_rate)
+    IDLE_TIMEOUT = max(0, args.idle_timeout)
+    RATE_LIMITS = {opcode: (rate, burst) for opcode, rate, burst in
+                   ((0x00, args.join_limit, JOIN_BURST), (0x01, args.move_limit, MOVE_BURST)) if rate > 0}
+    QUEUE_EXCESS_MOVES = args.queue_excess_moves and 0x01 in RATE_LIMITS
+    BOT_ROLES = tuple(Player.CMAN if name == 'cman' else Player.SPIRIT for name in args.bots)
+    BOT_FILL_DELAY = max(0, args.bot_delay)
+    BOT_MOVE_RATE = max(0.1, args.bot_rate)
+    for relay in args.relay:
+        host, _, port = relay.rpartition(':')
+        RELAYS.append((socket.gethostbyname(host), int(port)))
     
     main()
\ No newline at end of file
@@ -0,0 +1,197 @@
+import heapq
+import time
+
+class Timer:
+    """A callback scheduled on a Timers instance."""
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled', 'owner')
+
+    def __init__(self, deadline, callback, args, owner):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.owner = owner
+
+    def cancel(self):
+        """Prevents the callback from running. Cancelling twice, or after it ran, is harmless."""
+        if not self.cancelled:
+            self.cancelled = True
+            self.owner._timer_cancelled()
+
+class Timers:
+    """
+    
+    A min-heap of one-shot timers for select() style loops.
+
+    Cancelled timers are dropped lazily when they reach the top of the heap, and the
+    heap is compacted once they make up most of it, so a sweep only ever touches the
+    timers that are actually due.
+
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []  # (deadline, sequence, Timer)
+        self.sequence = 0  # Keeps callbacks with equal deadlines in scheduling order
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def call_at(self, deadline, callback, *args):
+        """
+        
+        Schedules callback(*args) to run once the clock reaches deadline.
+
+        Returns:
+
+        Timer: A handle that can be used to cancel the call
+
+        """
+        timer = Timer(deadline, callback, args, self)
+        self.sequence += 1
+        heapq.heappush(self.heap, (deadline, self.sequence, timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        
+        Schedules callback(*args) to run after delay seconds.
+
+        Returns:
+
+        Timer: A handle that can be used to cancel the call
+
+        """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def _timer_cancelled(self):
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def _drop_cancelled(self):
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+
+    def timeout(self):
+        """
+        
+        Returns:
+
+        float: Seconds until the next timer is due (0 if one is overdue), or None if no timer is pending
+
+        """
+        self._drop_cancelled()
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - self.clock())
+
+    def run_expired(self):
+        """
+        
+        Runs every timer that is due.
+
+        Returns:
+
+        int: The number of callbacks that ran
+
+        """
+        heap = self.heap
+        now = self.clock()
+        ran = 0
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            timer.cancelled = True  # Fired timers can no longer be cancelled
+            timer.callback(*timer.args)
+            ran += 1
+        return ran
+
+class TimerWheel:
+    """
+
+    A hashed timer wheel for many coarse timers, such as idle timeouts.
+
+    Deadlines are rounded up to the wheel's resolution and hashed into a fixed number of
+    slots, so scheduling and cancelling cost O(1) however many timers are pending, where
+    the heap of Timers pays O(log n). Cancelled timers are dropped when their slot comes
+    around. The wheel does not wake anyone up: its owner calls advance() about once per
+    resolution, e.g. from a Timers callback.
+
+    """
+    def __init__(self, resolution=1.0, slots=64, clock=time.monotonic):
+        self.clock = clock
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.tick = int(clock() / resolution)  # Last tick whose slot was swept
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def call_at(self, deadline, callback, *args):
+        """
+        
+        Schedules callback(*args) to run once advance() finds the clock past deadline.
+
+        Returns:
+
+        Timer: A handle that can be used to cancel the call
+
+        """
+        timer = Timer(deadline, callback, args, self)
+        tick = max(-int(-deadline // self.resolution), self.tick + 1)
+        self.slots[tick % len(self.slots)].append(timer)
+        self.pending += 1
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        
+        Schedules callback(*args) to run after delay seconds, give or take the resolution.
+
+        Returns:
+
+        Timer: A handle that can be used to cancel the call
+
+        """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def _timer_cancelled(self):
+        self.pending -= 1
+
+    def advance(self):
+        """
+        
+        Runs every timer that is due, sweeping the slots of the ticks passed since the last call.
+
+        Returns:
+
+        int: The number of callbacks that ran
+
+        """
+        now = self.clock()
+        now_tick = int(now / self.resolution)
+        slots = self.slots
+        ran = 0
+        # Past one rotation every slot has been swept, so a long pause costs at most one pass
+        for tick in range(self.tick + 1, min(now_tick, self.tick + len(slots)) + 1):
+            self.tick = tick  # Timers scheduled by the callbacks below go to later slots
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            due = [timer for timer in slot if not timer.cancelled and timer.deadline <= now]
+            slots[tick % len(slots)] = [timer for timer in slot if not timer.cancelled and timer.deadline > now]
+            for timer in due:
+                timer.cancelled = True  # Fired timers can no longer be cancelled
+                self.pending -= 1
+                timer.callback(*timer.args)
+                ran += 1
+        self.tick = max(self.tick, now_tick)
+        return ran
@@ -1,4 +1,4 @@
-import pynput, time
+import pynput, queue
 
 def _flush_input():
     try:
@@ -9,10 +9,69 @@ def _flush_input():
         import sys, termios
         termios.tcflush(sys.stdin, termios.TCIOFLUSH)
 
+class KeyListener:
+    """
+
+    Listens to the keyboard from one long-lived background thread and queues every key press,
+    so callers can drain the presses without blocking and without missing any between calls.
+
+    """
+    def __init__(self):
+        self.events = queue.SimpleQueue()
+        self.listener = None
+
+    def _on_press(self, key):
+        try:
+            self.events.put(key.char)
+        except AttributeError:
+            self.events.put(str(key))
+
+    def start(self):
+        """Starts the listener thread, unless it is already running."""
+        if self.listener is None:
+            self.listener = pynput.keyboard.Listener(on_press=self._on_press)
+            self.listener.start()
+
+    def stop(self):
+        """Stops the listener thread."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def drain(self):
+        """
+
+        Returns:
+
+        list[str]: The keys pressed since the previous call, without duplicates, in the order they were first pressed
+
+        """
+        keys_lst = []
+        while True:
+            try:
+                key = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if key not in keys_lst:
+                keys_lst.append(key)
+        if keys_lst:
+            _flush_input()
+        return keys_lst
+
+_key_listener = KeyListener()
+
+def start_key_listener():
+    """
+
+    Starts listening to the keyboard, so presses made before the first get_pressed_keys() call are kept.
+
+    """
+    _key_listener.start()
+
 def get_pressed_keys(keys_filter = None):
     """
     
-    Returns a list of all pressed keys at the time of the call.
+    Returns a list of all keys pressed since the previous call.
 
     Parameters:
 
@@ -20,22 +79,11 @@ def get_pressed_keys(keys_filter = None):
 
     Returns:
 
-    list[str]: A list of currently pressed keys.
+    list[str]: A list of pressed keys.
 
     """
-    keys_lst = []
-    def on_press(key):
-        try:
-            if key.char not in keys_lst:
-                keys_lst.append(key.char)
-        except AttributeError:
-            if key not in keys_lst:
-                keys_lst.append(str(key))
-    listener = pynput.keyboard.Listener(on_press=on_press)
-    listener.start()
-    time.sleep(0.01)
-    listener.stop()
-    _flush_input()
+    _key_listener.start()
+    keys_lst = _key_listener.drain()
     if keys_filter is None:
         return keys_lst
     else: